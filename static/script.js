@@ -82,6 +82,7 @@ async function loadDevices() {
         }
 
         list.innerHTML = '';
+        updateGroupCastBtn();
         devices.forEach(d => {
             const item = document.createElement('div');
             item.className = 'device-item';
@@ -101,6 +102,16 @@ async function loadDevices() {
             icon.className = 'cast-icon';
             icon.textContent = '📺';
 
+            // Tick several devices to cast to them together
+            const select = document.createElement('input');
+            select.type = 'checkbox';
+            select.className = 'device-select';
+            select.value = d.udn;
+            select.title = 'Add to group';
+            select.addEventListener('click', (event) => event.stopPropagation());
+            select.addEventListener('change', updateGroupCastBtn);
+
+            item.appendChild(select);
             item.appendChild(info);
             item.appendChild(icon);
             item.addEventListener('click', (event) => castToDevice(d.udn, event));
@@ -137,14 +148,8 @@ async function refreshDevices() {
     }
 }
 
-async function castToDevice(udn, castEvent) {
-    if (!currentCastStreamId) return;
-    
-    const item = castEvent ? castEvent.currentTarget : null;
-    const originalBg = item ? item.style.background : '';
-    if (item) item.style.background = 'rgba(148, 163, 184, 0.2)';
-    
-    // Get station metadata BEFORE closing modal
+// Station name and logo for the cast target; read BEFORE closing the modal
+function castStationMeta() {
     const castStationElem = document.getElementById('castStationName');
     const stationName = castStationElem ? castStationElem.innerText.replace('Target Station: ', '') : 'Unknown Station';
     
@@ -156,6 +161,49 @@ async function castToDevice(udn, castEvent) {
         const logoElem = item ? item.querySelector('.stream-logo') : null;
         if (logoElem) logo = logoElem.src;
     }
+    return { stationName, logo };
+}
+
+function enterCastingState(target, castingTo, stationName, logo) {
+    // Update playback bar for DLNA
+    const bar = document.getElementById('playback-bar');
+    
+    safeSetText('playback-station-name', stationName);
+    safeSetText('playback-status', `Casting to ${castingTo}`);
+    const logoPlaying = document.getElementById('playback-logo');
+    if (logoPlaying) logoPlaying.src = logo;
+    
+    if (bar) bar.style.display = 'flex';
+    
+    // Set session storage
+    sessionStorage.setItem('isPlaying', currentCastStreamId);
+    sessionStorage.setItem('isCasting', 'true');
+    sessionStorage.setItem('castDeviceTarget', target); 
+    sessionStorage.setItem('stationName', stationName);
+    sessionStorage.setItem('stationLogo', logo);
+    sessionStorage.setItem('castingTo', castingTo);
+    
+    // Stop any local playback
+    const audio = document.getElementById('main-audio');
+    if (audio) {
+        audio.pause();
+        audio.src = "";
+    }
+    
+    // Update local play buttons
+    updatePlayBtns(currentCastStreamId);
+
+    closeCastModal();
+}
+
+async function castToDevice(udn, castEvent) {
+    if (!currentCastStreamId) return;
+    
+    const item = castEvent ? castEvent.currentTarget : null;
+    const originalBg = item ? item.style.background : '';
+    if (item) item.style.background = 'rgba(148, 163, 184, 0.2)';
+    
+    const { stationName, logo } = castStationMeta();
 
     const payload = { video_id: currentCastStreamId };
     if (typeof udn === 'string' && (udn.includes('://') || udn.includes('.'))) {
@@ -173,35 +221,8 @@ async function castToDevice(udn, castEvent) {
         const result = await response.json();
         
         if (result.success) {
-            // Update playback bar for DLNA
-            const bar = document.getElementById('playback-bar');
-            
-            safeSetText('playback-station-name', stationName);
-            safeSetText('playback-status', `Casting to ${result.device_name || 'Device'}`);
-            const logoPlaying = document.getElementById('playback-logo');
-            if (logoPlaying) logoPlaying.src = logo;
-            
-            if (bar) bar.style.display = 'flex';
-            
-            // Set session storage
-            sessionStorage.setItem('isPlaying', currentCastStreamId);
-            sessionStorage.setItem('isCasting', 'true');
-            sessionStorage.setItem('castDeviceTarget', udn); 
-            sessionStorage.setItem('stationName', stationName);
-            sessionStorage.setItem('stationLogo', logo);
-            sessionStorage.setItem('castingTo', result.device_name || 'Device');
-            
-            // Stop any local playback
-            const audio = document.getElementById('main-audio');
-            if (audio) {
-                audio.pause();
-                audio.src = "";
-            }
-            
-            // Update local play buttons
-            updatePlayBtns(currentCastStreamId);
-
-            closeCastModal();
+            sessionStorage.removeItem('castGroup');
+            enterCastingState(udn, result.device_name || 'Device', stationName, logo);
         } else {
             alert('Cast failed: ' + result.message);
         }
@@ -218,6 +239,53 @@ function castToManualIp() {
     if (!ip) return alert('Please enter an IP or URL');
     castToDevice(ip, null);
 }
+
+function selectedCastUdns() {
+    return Array.from(document.querySelectorAll('.device-select:checked')).map(box => box.value);
+}
+
+function updateGroupCastBtn() {
+    const btn = document.getElementById('castGroupBtn');
+    const count = selectedCastUdns().length;
+    btn.disabled = count === 0;
+    btn.innerText = count > 1 ? `Cast to ${count} devices` : 'Cast to selected';
+}
+
+async function castToSelected() {
+    const udns = selectedCastUdns();
+    if (!currentCastStreamId || udns.length === 0) return;
+    const btn = document.getElementById('castGroupBtn');
+    btn.disabled = true;
+    btn.innerText = '⌛ Casting...';
+
+    const { stationName, logo } = castStationMeta();
+    try {
+        const response = await fetch('/api/dlna/cast_group', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ video_id: currentCastStreamId, udns })
+        });
+        const result = await response.json();
+        const ok = (result.results || []).filter(r => r.success);
+        const failed = (result.results || []).filter(r => !r.success);
+        if (ok.length > 0) {
+            sessionStorage.setItem('castGroup', JSON.stringify(ok.map(r => r.udn)));
+            const castingTo = ok.length > 1 ? `${ok.length} devices` : ok[0].device_name;
+            enterCastingState(ok[0].udn, castingTo, stationName, logo);
+        }
+        if (failed.length > 0) {
+            alert('Cast failed on: ' + failed.map(r => `${r.device_name} (${r.message})`).join(', '));
+        }
+        if (ok.length === 0 && failed.length === 0) {
+            alert('Cast failed: ' + result.message);
+        }
+    } catch (e) {
+        console.error('Group Cast Error:', e);
+        alert('Request failed: ' + e.message);
+    } finally {
+        updateGroupCastBtn();
+    }
+}
 function copyLink(url) {
     navigator.clipboard.writeText(url).then(() => {
         alert('Copied stream URL to clipboard!');
@@ -229,6 +297,7 @@ function clearPlaybackState() {
     sessionStorage.removeItem('isPlaying');
     sessionStorage.removeItem('isCasting');
     sessionStorage.removeItem('castDeviceTarget');
+    sessionStorage.removeItem('castGroup');
     sessionStorage.removeItem('stationName');
     sessionStorage.removeItem('stationLogo');
     sessionStorage.removeItem('castingTo');
@@ -257,9 +326,12 @@ async function stopAllAudio() {
     // If we were casting, send a stop request to the backend
     const isCasting = sessionStorage.getItem('isCasting');
     const castTarget = sessionStorage.getItem('castDeviceTarget');
+    const castGroup = sessionStorage.getItem('castGroup');
     if (isCasting === 'true' && castTarget) {
         const payload = {};
-        if (castTarget.includes('.') || castTarget.includes('://')) {
+        if (castGroup) {
+            payload.udns = JSON.parse(castGroup);
+        } else if (castTarget.includes('.') || castTarget.includes('://')) {
             payload.manual_location = castTarget;
         } else {
             payload.udn = castTarget;
@@ -279,6 +351,24 @@ async function stopAllAudio() {
     clearPlaybackState();
 }
 
+// Restart a dropped local stream (e.g. across a server restart) with backoff
+let reconnectAttempts = 0;
+function reconnectPlayer() {
+    const id = sessionStorage.getItem('isPlaying');
+    if (!id || sessionStorage.getItem('isCasting') === 'true') return;
+    if (reconnectAttempts >= 5) {
+        clearPlaybackState();
+        return;
+    }
+    const delay = 1000 * 2 ** reconnectAttempts++;
+    setTimeout(() => {
+        if (sessionStorage.getItem('isPlaying') !== id) return;
+        const audio = document.getElementById('main-audio');
+        audio.src = `/stream.mp3?v=${id}&t=${Date.now()}`;
+        audio.play().catch(e => console.log("Reconnect failed:", e));
+    }, delay);
+}
+
 function togglePlayer(id) {
     const audio = document.getElementById('main-audio');
     const bar = document.getElementById('playback-bar');
@@ -357,6 +447,10 @@ document.addEventListener('DOMContentLoaded', () => {
     
     sessionStorage.setItem('server_id', currentServerId);
     restoreUIState();
+    const mainAudio = document.getElementById('main-audio');
+    mainAudio.addEventListener('error', reconnectPlayer);
+    mainAudio.addEventListener('ended', reconnectPlayer);
+    mainAudio.addEventListener('playing', () => { reconnectAttempts = 0; });
     const volControl = document.getElementById('volume-control');
     volControl.addEventListener('input', (e) => {
         const vol = e.target.value;
@@ -477,6 +571,279 @@ function closeErrorModal() {
     document.getElementById('errorModalOverlay').style.display = 'none';
 }
 
+// ── Station list ──────────────────────────────────────────────────────────────
+// Virtualized: only rows in (or near) the viewport exist in the DOM, and pages of
+// /api/stations are fetched as they scroll into view. Rows have a fixed height and
+// every page carries the start index of each group, so any row's offset is known
+// before its page has loaded.
+const ROW_HEIGHT = 84;
+const HEADER_HEIGHT = 34;
+const PAGE_SIZE = 50;
+const OVERSCAN = 6;
+
+const stationView = {
+    generation: 0,       // bumped when the query changes; stale responses are dropped
+    version: null,       // server list version the cached rows belong to
+    query: '',
+    loaded: false,
+    total: 0,
+    groups: [],          // [{start, name}] over the filtered list
+    rows: new Map(),     // row index -> station
+    loadedPages: new Set(),
+    loadingPages: new Set()
+};
+let renderQueued = false;
+
+// Group headers at or before row `idx`
+function headersBefore(idx) {
+    const groups = stationView.groups;
+    let lo = 0, hi = groups.length;
+    while (lo < hi) {
+        const mid = (lo + hi) >> 1;
+        if (groups[mid].start <= idx) lo = mid + 1; else hi = mid;
+    }
+    return lo;
+}
+
+function rowTop(idx) {
+    return idx * ROW_HEIGHT + headersBefore(idx) * HEADER_HEIGHT;
+}
+
+// Last row whose top is at or above `y`
+function rowAt(y) {
+    let lo = 0, hi = stationView.total - 1;
+    while (lo < hi) {
+        const mid = (lo + hi + 1) >> 1;
+        if (rowTop(mid) <= y) lo = mid; else hi = mid - 1;
+    }
+    return lo;
+}
+
+function visibleRange() {
+    if (!stationView.loaded || stationView.total === 0) return null;
+    const container = document.getElementById('stream-list-container');
+    const rect = container.getBoundingClientRect();
+    const top = Math.max(0, -rect.top);
+    const bottom = Math.max(top, window.innerHeight - rect.top);
+    return [
+        Math.max(0, rowAt(top) - OVERSCAN),
+        Math.min(stationView.total - 1, rowAt(bottom) + OVERSCAN)
+    ];
+}
+
+function resetStationView() {
+    stationView.rows.clear();
+    stationView.loadedPages.clear();
+    stationView.loadingPages.clear();
+}
+
+async function loadStationPage(page, force = false) {
+    if (stationView.loadingPages.has(page)) return;
+    if (!force && stationView.loadedPages.has(page)) return;
+    const generation = stationView.generation;
+    stationView.loadingPages.add(page);
+
+    const params = new URLSearchParams({ offset: page * PAGE_SIZE, limit: PAGE_SIZE });
+    if (stationView.query) params.set('q', stationView.query);
+    try {
+        const response = await fetch(`/api/stations?${params}`);
+        if (!response.ok) throw new Error('Offline');
+        const data = await response.json();
+        if (generation !== stationView.generation) return;
+
+        if (data.version !== stationView.version) {
+            // List edited server-side: every cached row may have moved
+            resetStationView();
+            stationView.version = data.version;
+        }
+        stationView.loaded = true;
+        stationView.total = data.total;
+        stationView.groups = data.groups;
+        data.stations.forEach((stream, i) => stationView.rows.set(data.offset + i, stream));
+        stationView.loadedPages.add(page);
+    } catch (e) {
+        console.error(`Station page ${page} failed`, e);
+    } finally {
+        stationView.loadingPages.delete(page);
+    }
+    scheduleStationRender();
+}
+
+// Re-fetch the pages on screen so listener counts and availability stay current
+function refreshVisiblePages() {
+    const range = visibleRange();
+    if (!range) {
+        loadStationPage(0, true);
+        return;
+    }
+    for (let p = Math.floor(range[0] / PAGE_SIZE); p <= Math.floor(range[1] / PAGE_SIZE); p++) {
+        loadStationPage(p, true);
+    }
+}
+
+function scheduleStationRender() {
+    if (renderQueued) return;
+    renderQueued = true;
+    requestAnimationFrame(() => {
+        renderQueued = false;
+        renderStationWindow();
+    });
+}
+
+function streamItemState(stream) {
+    const avail = stream.availability || 'checking';
+    const live = stream.listeners > 0 && avail === 'available';
+    return {
+        avail,
+        live,
+        dotTitle: stream.listeners > 0 ? `${stream.listeners} listening` : avail,
+        subText: `${stream.id}${stream.listeners > 0 ? ' • ' + stream.listeners + ' listening' : ''}`
+    };
+}
+
+function createStreamItem(stream, playingId) {
+    const { avail, live, dotTitle, subText } = streamItemState(stream);
+    const item = document.createElement('div');
+    item.className = 'stream-item';
+    item.dataset.streamId = stream.id;
+    // Build with escaped text; user-controlled values (name/url/
+    // group/tvg_id) go through closures, never an inline handler string.
+    item.innerHTML = `
+        <span class="avail-dot avail-${escapeHtml(avail)}${live ? ' live' : ''}" title="${escapeHtml(dotTitle)}"></span>
+        <img src="${escapeHtml(stream.logo || '')}" class="stream-logo" alt="Logo" loading="lazy" onerror="this.style.background='var(--logo-placeholder)'">
+        <div class="stream-info">
+            <div class="stream-name-wrapper">
+                <span class="station-name-text">${escapeHtml(stream.name)}</span>
+            </div>
+            <span class="stream-sub">${escapeHtml(subText)}</span>
+        </div>
+        <div class="stream-actions">
+            <button title="Play" class="action-link play-btn${stream.id === playingId ? ' playing' : ''}" id="play-btn-${escapeHtml(stream.id)}">${stream.id === playingId ? '⏹' : '▶'}</button>
+            <button title="Cast" class="action-link cast-btn">📺</button>
+            <button title="Edit" class="action-link edit-btn">✎</button>
+            <a title="YouTube" href="https://www.youtube.com/watch?v=${encodeURIComponent(stream.id)}" class="action-link" target="_blank">↗</a>
+        </div>`;
+
+    item.querySelector('.play-btn').addEventListener('click', () => togglePlayer(stream.id));
+    item.querySelector('.cast-btn').addEventListener('click', () => openCastModal(stream.id, stream.name));
+    item.querySelector('.edit-btn').addEventListener('click', () => openEditModal(stream.id, stream.name, stream.url, stream.group, stream.tvg_id));
+    return item;
+}
+
+// Patch only changed attributes on an existing element
+function patchStreamItem(item, stream, playingId) {
+    const { avail, live, dotTitle, subText } = streamItemState(stream);
+    const dot = item.querySelector('.avail-dot');
+    const dotClass = `avail-dot avail-${avail}${live ? ' live' : ''}`;
+    if (dot.className !== dotClass) dot.className = dotClass;
+    if (dot.title !== dotTitle) dot.title = dotTitle;
+
+    const sub = item.querySelector('.stream-sub');
+    if (sub.textContent !== subText) sub.textContent = subText;
+
+    const playBtn = item.querySelector('.play-btn');
+    const isActive = stream.id === playingId;
+    const wantedLabel = isActive ? '⏹' : '▶';
+    if (playBtn.innerText !== wantedLabel) playBtn.innerText = wantedLabel;
+    playBtn.classList.toggle('playing', isActive);
+}
+
+// Measure marquee after insert, play once then rely on hover
+function initMarquee(item) {
+    const nameEl = item.querySelector('.station-name-text');
+    const overflow = nameEl.scrollWidth - nameEl.parentElement.clientWidth;
+    if (overflow > 0) {
+        nameEl.style.setProperty('--marquee-offset', `-${overflow}px`);
+        nameEl.classList.add('init-play');
+        nameEl.addEventListener('animationend', () => nameEl.classList.remove('init-play'), { once: true });
+    }
+}
+
+function renderStationWindow() {
+    const container = document.getElementById('stream-list-container');
+    if (!stationView.loaded) return;
+
+    if (stationView.total === 0) {
+        container.classList.remove('virtual-list');
+        container.style.height = '';
+        container.innerHTML = stationView.query
+            ? '<p style="color: var(--text-dim); font-style: italic;">No stations match your search.</p>'
+            : '<p style="color: var(--text-dim); font-style: italic;">No stations found in youtube.m3u.</p>';
+        return;
+    }
+    if (!container.classList.contains('virtual-list')) {
+        container.innerHTML = '';
+        container.classList.add('virtual-list');
+    }
+    container.style.height = `${rowTop(stationView.total)}px`;
+
+    const [first, last] = visibleRange();
+    for (let p = Math.floor(first / PAGE_SIZE); p <= Math.floor(last / PAGE_SIZE); p++) {
+        loadStationPage(p);
+    }
+
+    const existing = {};
+    Array.from(container.children).forEach(el => { existing[el.dataset.key] = el; });
+    const keep = new Set();
+    const playingId = sessionStorage.getItem('isPlaying');
+
+    stationView.groups.forEach(group => {
+        if (group.start < first || group.start > last) return;
+        const key = `h:${group.start}:${group.name}`;
+        let header = existing[key];
+        if (!header) {
+            header = document.createElement('div');
+            header.className = 'group-header';
+            header.dataset.key = key;
+            header.textContent = group.name;
+            container.appendChild(header);
+        }
+        header.style.top = `${rowTop(group.start) - HEADER_HEIGHT}px`;
+        keep.add(key);
+    });
+
+    for (let idx = first; idx <= last; idx++) {
+        const stream = stationView.rows.get(idx);
+        const key = stream ? `s:${idx}:${stream.id}` : `p:${idx}`;
+        let item = existing[key];
+        if (!item) {
+            if (stream) {
+                item = createStreamItem(stream, playingId);
+            } else {
+                item = document.createElement('div');
+                item.className = 'stream-item placeholder';
+            }
+            item.dataset.key = key;
+            container.appendChild(item);
+            if (stream) initMarquee(item);
+        } else if (stream) {
+            patchStreamItem(item, stream, playingId);
+        }
+        item.style.top = `${rowTop(idx)}px`;
+        keep.add(key);
+    }
+
+    Object.entries(existing).forEach(([key, el]) => {
+        if (!keep.has(key)) el.remove();
+    });
+}
+
+function onStationSearch(value) {
+    clearTimeout(onStationSearch.timer);
+    onStationSearch.timer = setTimeout(() => {
+        const query = value.trim();
+        if (query === stationView.query) return;
+        stationView.query = query;
+        stationView.generation++;
+        stationView.loaded = false;
+        resetStationView();
+        loadStationPage(0);
+    }, 250);
+}
+
+window.addEventListener('scroll', scheduleStationRender, { passive: true });
+window.addEventListener('resize', scheduleStationRender);
+
 async function updateDashboard() {
     const badge = document.getElementById('system-status-badge');
     try {
@@ -497,146 +864,15 @@ async function updateDashboard() {
         // Check for server restart
         const storedServerId = sessionStorage.getItem('server_id');
         if (data.server_id && storedServerId && data.server_id !== storedServerId) {
-            console.log("Server restart detected, clearing stale playback state.");
-            clearPlaybackState();
+            // The new server re-casts handed-over renderers and the local
+            // player reconnects by itself, so playback state stays.
+            console.log("Server restart detected.");
         }
         if (data.server_id) {
             sessionStorage.setItem('server_id', data.server_id);
         }
 
-        const container = document.getElementById('stream-list-container');
-        if (data.streams.length > 0) {
-            const playingId = sessionStorage.getItem('isPlaying');
-
-            // Group by tvg_id preserving order
-            const groupMap = {};
-            const groupOrder = [];
-            data.streams.forEach(stream => {
-                const key = stream.tvg_id || 'Other';
-                if (!groupMap[key]) { groupMap[key] = []; groupOrder.push(key); }
-                groupMap[key].push(stream);
-            });
-
-            // Build index of existing stream-item elements keyed by stream id
-            const existingItems = {};
-            container.querySelectorAll('.stream-item[data-stream-id]').forEach(el => {
-                existingItems[el.dataset.streamId] = el;
-            });
-
-            // Build/update group containers, patching existing items in place
-            const seenIds = new Set();
-            const seenGroups = new Set();
-
-            groupOrder.forEach(key => {
-                seenGroups.add(key);
-                let groupEl = container.querySelector(`.stream-group[data-group="${CSS.escape(key)}"]`);
-                if (!groupEl) {
-                    groupEl = document.createElement('div');
-                    groupEl.className = 'stream-group';
-                    groupEl.dataset.group = key;
-                    groupEl.innerHTML = `<div class="group-header">${escapeHtml(key)}</div><div class="stream-list"></div>`;
-                    container.appendChild(groupEl);
-                }
-                const listEl = groupEl.querySelector('.stream-list');
-
-                groupMap[key].forEach((stream, idx) => {
-                    seenIds.add(stream.id);
-                    const avail = stream.availability || 'checking';
-                    const live = stream.listeners > 0 && avail === 'available';
-                    const dotTitle = stream.listeners > 0 ? `${stream.listeners} listening` : avail;
-                    const subText = `${stream.id}${stream.listeners > 0 ? ' • ' + stream.listeners + ' listening' : ''}`;
-
-                    let item = existingItems[stream.id];
-                    if (!item) {
-                        // Create new element only when it doesn't exist yet
-                        item = document.createElement('div');
-                        item.className = 'stream-item';
-                        item.dataset.streamId = stream.id;
-                        // Build with escaped text; user-controlled values (name/url/
-                        // group/tvg_id) go through closures, never an inline handler string.
-                        item.innerHTML = `
-                            <span class="avail-dot avail-${escapeHtml(avail)}${live ? ' live' : ''}" title="${escapeHtml(dotTitle)}"></span>
-                            <img src="${escapeHtml(stream.logo || '')}" class="stream-logo" alt="Logo" onerror="this.style.background='var(--logo-placeholder)'">
-                            <div class="stream-info">
-                                <div class="stream-name-wrapper">
-                                    <span class="station-name-text">${escapeHtml(stream.name)}</span>
-                                </div>
-                                <span class="stream-sub">${escapeHtml(subText)}</span>
-                            </div>
-                            <div class="stream-actions">
-                                <button title="Play" class="action-link play-btn${stream.id === playingId ? ' playing' : ''}" id="play-btn-${escapeHtml(stream.id)}">${stream.id === playingId ? '⏹' : '▶'}</button>
-                                <button title="Cast" class="action-link cast-btn">📺</button>
-                                <button title="Edit" class="action-link edit-btn">✎</button>
-                                <a title="YouTube" href="https://www.youtube.com/watch?v=${encodeURIComponent(stream.id)}" class="action-link" target="_blank">↗</a>
-                            </div>`;
-                        listEl.appendChild(item);
-
-                        item.querySelector('.play-btn').addEventListener('click', () => togglePlayer(stream.id));
-                        item.querySelector('.cast-btn').addEventListener('click', () => openCastModal(stream.id, stream.name));
-                        item.querySelector('.edit-btn').addEventListener('click', () => openEditModal(stream.id, stream.name, stream.url, stream.group, stream.tvg_id));
-
-                        // Measure marquee after insert, play once then rely on hover
-                        const nameEl = item.querySelector('.station-name-text');
-                        const overflow = nameEl.scrollWidth - nameEl.parentElement.clientWidth;
-                        if (overflow > 0) {
-                            nameEl.style.setProperty('--marquee-offset', `-${overflow}px`);
-                            nameEl.classList.add('init-play');
-                            nameEl.addEventListener('animationend', () => nameEl.classList.remove('init-play'), { once: true });
-                        }
-                    } else {
-                        // Patch only changed attributes on existing element
-                        const dot = item.querySelector('.avail-dot');
-                        const dotClass = `avail-dot avail-${avail}${live ? ' live' : ''}`;
-                        if (dot.className !== dotClass) dot.className = dotClass;
-                        if (dot.title !== dotTitle) dot.title = dotTitle;
-
-                        const sub = item.querySelector('.stream-sub');
-                        if (sub.textContent !== subText) sub.textContent = subText;
-
-                        const playBtn = item.querySelector(`#play-btn-${stream.id}`);
-                        const isActive = stream.id === playingId;
-                        const wantedLabel = isActive ? '⏹' : '▶';
-                        if (playBtn) {
-                            if (playBtn.innerText !== wantedLabel) playBtn.innerText = wantedLabel;
-                            playBtn.classList.toggle('playing', isActive);
-                        }
-
-                        // Move into correct group list if it changed groups
-                        if (item.parentElement !== listEl) {
-                            const ref = listEl.children[idx] || null;
-                            listEl.insertBefore(item, ref);
-                        } else if (listEl.children[idx] !== item) {
-                            // Already in right list but wrong position — insertBefore the element
-                            // currently at idx (which shifts down), only if truly misplaced
-                            const ref = listEl.children[idx] || null;
-                            listEl.insertBefore(item, ref);
-                        }
-                    }
-                });
-            });
-
-            // Remove items that no longer exist in data
-            Object.entries(existingItems).forEach(([id, el]) => {
-                if (!seenIds.has(id)) el.remove();
-            });
-
-            // Remove groups that no longer exist
-            container.querySelectorAll('.stream-group[data-group]').forEach(el => {
-                if (!seenGroups.has(el.dataset.group)) el.remove();
-            });
-
-            // Ensure group order matches groupOrder — only move if position is wrong
-            groupOrder.forEach((key, idx) => {
-                const groupEl = container.querySelector(`.stream-group[data-group="${CSS.escape(key)}"]`);
-                if (groupEl && container.children[idx] !== groupEl) {
-                    container.insertBefore(groupEl, container.children[idx] || null);
-                }
-            });
-        } else if (!container.querySelector('.stream-group')) {
-            // Only show "no stations" if we've never populated — empty response when list
-            // already exists is a transient server-side failure, don't wipe the display
-            container.innerHTML = '<p style="color: var(--text-dim); font-style: italic;">No stations found in youtube.m3u.</p>';
-        }
+        refreshVisiblePages();
 
         // Update errors
         const errorContainer = document.getElementById('error-log-container-modal');
@@ -739,12 +975,26 @@ async function refreshM3U() {
 let reorderData = [];   // flat array of stream objects in current order
 let dragSrcIdx = null;
 
+// Reordering needs the whole list, so walk every page
+async function fetchAllStations() {
+    const stations = [];
+    let total = Infinity;
+    while (stations.length < total) {
+        const response = await fetch(`/api/stations?offset=${stations.length}&limit=500`);
+        if (!response.ok) throw new Error('Offline');
+        const data = await response.json();
+        total = data.total;
+        if (!data.stations.length) break;
+        stations.push(...data.stations);
+    }
+    return stations;
+}
+
 function openReorderModal() {
     document.getElementById('reorderModalOverlay').style.display = 'flex';
-    fetch('/api/stats')
-        .then(r => r.json())
-        .then(data => {
-            reorderData = data.streams || [];
+    fetchAllStations()
+        .then(stations => {
+            reorderData = stations;
             renderReorderList();
         })
         .catch(() => {
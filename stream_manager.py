@@ -6,14 +6,26 @@ import socket
 import html
 import re
 import ipaddress
+import itertools
+import base64
+import json
+import mmap
+import select
+import signal
+import sys
 from urllib.parse import urlparse
 from datetime import datetime, timedelta
 from collections import deque
 from flask import Flask, Response, request, jsonify, render_template
-try:
-    import upnpclient
-except ImportError:
-    upnpclient = None
+
+IMPORT_STARTED = time.perf_counter()  # Baseline for the startup timing report
+
+# upnpclient pulls in lxml and is only needed for DLNA, so it's imported on first
+# use (load_upnpclient) rather than on every worker boot: discovery waits for the
+# first /api/dlna/* call, and nothing else touches it without a renderer to talk to.
+upnpclient = None
+UPNP_IMPORTED = False
+UPNP_LOCK = threading.Lock()
 
 app = Flask(__name__)
 
@@ -70,14 +82,1507 @@ LAST_GOOD_STREAMS = []  # Cache of last successful parse result
 # get_available_streams() while holding it. Single-file bind mount rules out atomic
 # rename, so we instead guarantee no read overlaps a truncating write.
 M3U_LOCK = threading.RLock()
+# Search index over the parsed playlist, rebuilt only when youtube.m3u changes
+STATION_INDEX = None
+INDEX_LOCK = threading.Lock()
+STATION_PAGE_MAX = 500
 
 # DLNA Discovery
 DLNA_DEVICES = []
 DEVICES_LOCK = threading.Lock()
 
 CACHE_DIR = "cache"
-if not os.path.exists(CACHE_DIR):
+
+# ── Startup ───────────────────────────────────────────────────────────────────
+# Importing this module is side-effect free: no threads, subprocesses, network or
+# filesystem writes. Background subsystems start once per process on the first
+# request, which under gunicorn (with or without --preload) is after the fork, so
+# they are never lost to it; DLNA discovery starts on the first /api/dlna/* call.
+# Phase timings (ms) are printed and kept for /api/stats, where dlna_discovery and
+# upnpclient_import only appear once DLNA has been used.
+STARTUP_TIMINGS = {}
+BACKGROUND_PID = None
+DISCOVERY_PID = None
+DISCOVERY_DONE = threading.Event()
+DISCOVERY_WAIT = 15  # How long the first device list waits for the initial scan
+BACKGROUND_LOCK = threading.Lock()
+
+def record_startup(phase, started):
+    STARTUP_TIMINGS[phase] = round((time.perf_counter() - started) * 1000, 1)
+
+def load_upnpclient():
+    """Import upnpclient on first use; returns the module, or None if missing."""
+    global upnpclient, UPNP_IMPORTED
+    if not UPNP_IMPORTED:
+        with UPNP_LOCK:
+            if not UPNP_IMPORTED:
+                started = time.perf_counter()
+                try:
+                    import upnpclient as module
+                    # Its own timeouts (10s per description fetch, 30s per SOAP
+                    # action) are read at call time; every request to a renderer
+                    # gets RENDERER_TIMEOUT instead, so a hung one frees its thread
+                    module.upnp.HTTP_TIMEOUT = RENDERER_TIMEOUT
+                    module.soap.SOAP_TIMEOUT = RENDERER_TIMEOUT
+                    upnpclient = module
+                except ImportError:
+                    upnpclient = None
+                UPNP_IMPORTED = True
+                record_startup('upnpclient_import', started)
+    return upnpclient
+
+def warm_station_index():
+    started = time.perf_counter()
+    get_station_index()
+    record_startup('playlist_parse', started)
+    print(f"Startup timings (ms): {STARTUP_TIMINGS}", flush=True)
+
+def start_background():
+    """Start this process's background subsystems, once. Cheap on purpose — the
+    playlist parse (which fans out availability/thumbnail checks) runs on its own
+    thread so the triggering request isn't held up."""
+    global BACKGROUND_PID
+    if BACKGROUND_PID == os.getpid():
+        return
+    with BACKGROUND_LOCK:
+        if BACKGROUND_PID == os.getpid():
+            return
+        BACKGROUND_PID = os.getpid()
+        started = time.perf_counter()
+        record_startup('first_request', IMPORT_STARTED)
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        clear_stale_timeshift()
+        start_handoff_listener()
+        resume_handoff()
+        start_watchdog_thread()
+        threading.Thread(target=warm_station_index, daemon=True).start()
+        record_startup('background_start', started)
+
+def create_app():
+    """Application factory (`gunicorn 'stream_manager:create_app()'`). Prepares
+    the cache directory, the drain-on-SIGTERM hook and the socket a draining
+    predecessor hands its streams to; everything else waits for
+    start_background() — unless a previous process left casts to resume."""
     os.makedirs(CACHE_DIR, exist_ok=True)
+    install_drain_handler()
+    start_handoff_listener()
+    record_startup('create_app', IMPORT_STARTED)
+    if os.path.exists(handoff_path()):
+        start_background()
+    return app
+
+# ── Watchdog ──────────────────────────────────────────────────────────────────
+# A client that stops reading without closing the socket (sleeping phone, half-open
+# DLNA renderer) parks generate() on `yield` forever, pinning a gunicorn thread,
+# the listener count and the per-IP slot (and, if it was the last listener, the
+# ffmpeg child). The watchdog tracks write progress per listener and output/CPU
+# per station transcoder, and reaps sessions past these thresholds (seconds; 0
+# disables a check). Reaping only unblocks the generator — the counters are always released
+# by its own `finally`.
+WATCHDOG_INTERVAL = float(os.getenv('WATCHDOG_INTERVAL', '5'))
+LISTENER_STALL_TIMEOUT = float(os.getenv('LISTENER_STALL_TIMEOUT', '60'))
+FFMPEG_IDLE_TIMEOUT = float(os.getenv('FFMPEG_IDLE_TIMEOUT', '45'))
+FFMPEG_SPIN_TIMEOUT = float(os.getenv('FFMPEG_SPIN_TIMEOUT', '15'))
+FFMPEG_SPIN_CPU = float(os.getenv('FFMPEG_SPIN_CPU', '0.5'))  # cores burned while idle
+STREAM_SESSIONS = {}  # Map session key to per-listener progress record
+SESSIONS_LOCK = threading.Lock()
+SESSION_SEQ = itertools.count(1)
+REAPED_SESSIONS = deque(maxlen=20)
+REAPED_TOTAL = 0
+try:
+    CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+except (AttributeError, ValueError, OSError):
+    CLOCK_TICKS = 100
+
+def process_cpu_seconds(pid):
+    """User+system CPU time of a child from /proc, or None where unavailable."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # comm (field 2) may contain spaces; everything after the last ')' is fixed
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    except (OSError, IndexError, ValueError):
+        return None
+
+def reap_session(sess, reason):
+    """Force a stalled listener's generator to unwind: shutting the client socket
+    down makes its blocked write raise."""
+    if sess.get('reaped'):
+        return
+    sess['reaped'] = reason
+    print(f"[{sess['id']}] Watchdog reaping: {reason}", flush=True)
+    sock = sess.get('socket')
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+def reap_graph(graph, reason):
+    """Kill a stuck decoder. Its graph then closes every output, so each
+    listener's read hits EOF and unwinds; they are all reported as reaped."""
+    if graph.get('reaped'):
+        return
+    graph['reaped'] = reason
+    print(f"[{graph['id']}] Watchdog reaping transcoder: {reason}", flush=True)
+    with ENCODERS_LOCK:
+        subscribers = [sub for enc in graph['outputs'].values() for sub in enc['subscribers'].values()]
+    for sub in subscribers:
+        sub['sess']['reaped'] = sub['sess']['reaped'] or reason
+    proc = graph.get('process')
+    if proc and proc.poll() is None:
+        try:
+            proc.kill()
+        except OSError:
+            pass
+
+def check_listener(sess, now):
+    """Return a reap reason for a listener that stopped reading, else None."""
+    stall_timeout = sess.get('stall_timeout', LISTENER_STALL_TIMEOUT)
+    if LISTENER_STALL_TIMEOUT and now - sess['last_write'] > stall_timeout:
+        # Only a stall if there was something to send; an idle transcoder is
+        # judged by check_graph instead.
+        if sess['bytes_in'] > sess['bytes_out']:
+            return f"listener stalled {int(now - sess['last_write'])}s"
+    return None
+
+def check_graph(graph, now):
+    """Return a reap reason for a transcoder past its thresholds, else None.
+    Also refreshes the rate samples shown in /api/stats."""
+    proc = graph.get('process')
+    if not proc or proc.poll() is not None:
+        return None
+
+    elapsed = now - graph['sample_time']
+    with ENCODERS_LOCK:
+        outputs = list(graph['outputs'].values())
+    if elapsed > 0:
+        for enc in outputs:
+            enc['rate'] = int((enc['bytes_in'] - enc['sample_bytes']) / elapsed)
+            enc['sample_bytes'] = enc['bytes_in']
+    if graph['source'] and graph['spawned']:
+        # Averaged since spawn: HLS reports arrive in per-segment bursts
+        graph['source']['upstream_rate'] = int(graph['upstream_bytes'] / max(1.0, now - graph['spawned']))
+    graph['sample_time'] = now
+
+    idle = now - graph['last_output']
+    cpu = process_cpu_seconds(proc.pid)
+    if cpu is not None and graph['sample_cpu'] is not None:
+        if elapsed <= 0 or idle < elapsed:
+            # Produced output since the last sample: busy, not spinning
+            graph['spin_since'] = None
+        elif (cpu - graph['sample_cpu']) / elapsed >= FFMPEG_SPIN_CPU:
+            graph['spin_since'] = graph['spin_since'] or now - elapsed
+        else:
+            graph['spin_since'] = None
+    graph['sample_cpu'] = cpu
+
+    if FFMPEG_SPIN_TIMEOUT and graph['spin_since'] and now - graph['spin_since'] > FFMPEG_SPIN_TIMEOUT:
+        return f"transcoder spinning with no output for {int(idle)}s"
+    if FFMPEG_IDLE_TIMEOUT and idle > FFMPEG_IDLE_TIMEOUT:
+        return f"transcoder produced no output for {int(idle)}s"
+    return None
+
+def watchdog_loop():
+    while True:
+        time.sleep(WATCHDOG_INTERVAL)
+        now = time.monotonic()
+        if os.path.exists(handoff_path()):
+            resume_handoff()  # Saved by a predecessor that stopped after we started
+        with ENCODERS_LOCK:
+            graphs = list(GRAPHS.values())
+        for graph in graphs:
+            try:
+                reason = check_graph(graph, now)
+                if reason:
+                    reap_graph(graph, reason)
+            except Exception as e:
+                print(f"[{graph['id']}] Watchdog check failed: {e}", flush=True)
+        with SESSIONS_LOCK:
+            sessions = list(STREAM_SESSIONS.values())
+        for sess in sessions:
+            try:
+                reason = check_listener(sess, now)
+                if reason:
+                    reap_session(sess, reason)
+            except Exception as e:
+                print(f"[{sess['id']}] Watchdog check failed: {e}", flush=True)
+
+def start_watchdog_thread():
+    threading.Thread(target=watchdog_loop, daemon=True).start()
+
+# ── Drain and handoff ─────────────────────────────────────────────────────────
+# On SIGTERM (docker stop, a Watchtower update, a gunicorn HUP reload) the worker
+# stops taking new streams and looks for a successor: another worker of the same
+# server, as a HUP reload starts beside the old one. If it finds one it hands it
+# the streams in flight, transcoders, listener connections and casts included, so
+# a reload is inaudible (see Live handoff). Whatever it still holds it keeps
+# serving for up to DRAIN_TIMEOUT seconds — keep it under the container's stop
+# timeout and gunicorn's --graceful-timeout — and then ends cleanly by stopping
+# the transcoders. Sockets and ffmpeg children can't cross a container swap, so
+# with no successor in reach the streams end there. With HANDOFF_ON_EXIT=1 the
+# casts in progress and the resolved sources of the stations playing are then
+# saved to cache/handoff.json, and the next process re-casts those renderers and
+# starts their transcoders without another yt-dlp round-trip; otherwise a plain
+# stop (`docker compose down`) leaves nothing behind. The dashboard player
+# reconnects on its own.
+DRAIN_TIMEOUT = float(os.getenv('DRAIN_TIMEOUT', '8'))
+HANDOFF_ON_EXIT = os.getenv('HANDOFF_ON_EXIT', '0') == '1'
+HANDOFF_MAX_AGE = 300  # Ignore handoff state older than this (seconds)
+DRAIN_DEADLINE = None  # Monotonic deadline once draining
+
+def handoff_path():
+    return os.path.join(CACHE_DIR, 'handoff.json')
+
+def handoff_state():
+    """The casts in progress and the sources of the stations playing."""
+    with CASTS_LOCK:
+        casts = [dict(cast) for cast in CAST_SESSIONS.values() if cast['state'] not in CAST_ENDED_STATES]
+    with ENCODERS_LOCK:
+        playing = set(GRAPHS) | {cast['video_id'] for cast in casts}
+    with MANIFEST_LOCK:
+        manifests = {vid: FORMAT_MANIFESTS[vid] for vid in playing if vid in FORMAT_MANIFESTS}
+    return {
+        "saved": time.time(), "server_id": SERVER_ID, "pid": os.getpid(),
+        "casts": casts, "manifests": manifests
+    }
+
+def save_handoff():
+    state = handoff_state()
+    tmp = handoff_path() + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp, handoff_path())
+    print(f"Handoff saved: {len(state['casts'])} casts, {len(state['manifests'])} sources", flush=True)
+
+def adopt_handoff_state(state, recast):
+    """Prime the source cache from a predecessor's state and take over its casts:
+    re-cast them (`recast`, their streams died with it) or, where their streams
+    were handed over live, just track them."""
+    with MANIFEST_LOCK:
+        for vid, manifest in state.get('manifests', {}).items():
+            if vid not in FORMAT_MANIFESTS or FORMAT_MANIFESTS[vid]['fetched'] < manifest['fetched']:
+                FORMAT_MANIFESTS[vid] = manifest
+    casts = state.get('casts', [])
+    if not recast:
+        with CASTS_LOCK:
+            for cast in casts:
+                cast['polled'], cast['polling'] = 0, False
+                CAST_SESSIONS.setdefault(cast['udn'], cast)
+        return
+    print(f"Resuming handoff: {len(casts)} casts", flush=True)
+    for cast in casts:
+        threading.Thread(target=start_cast, args=(cast,), daemon=True).start()
+
+def resume_handoff():
+    """Adopt state left by a predecessor that stopped with HANDOFF_ON_EXIT set.
+    The file is consumed, so this runs once per handoff."""
+    try:
+        with open(handoff_path()) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return
+    if state.get('server_id') == SERVER_ID and state.get('pid') == os.getpid():
+        return  # Our own, written while draining
+    try:
+        os.remove(handoff_path())
+    except OSError:
+        return  # Another worker got there first
+    if time.time() - state.get('saved', 0) > HANDOFF_MAX_AGE:
+        return
+    adopt_handoff_state(state, recast=True)
+
+def drain(exit_when_done):
+    remove_handoff_socket(handoff_socket_path(os.getpid()))  # No new arrivals
+    with SESSIONS_LOCK:
+        busy = bool(STREAM_SESSIONS)
+    with CASTS_LOCK:
+        busy = busy or any(cast['state'] not in CAST_ENDED_STATES for cast in CAST_SESSIONS.values())
+    successor = busy and find_successor(min(time.monotonic() + HANDOFF_WAIT, DRAIN_DEADLINE))
+    if successor:
+        with successor:
+            hand_over(successor)
+    elif busy and HANDOFF_ON_EXIT:
+        try:
+            save_handoff()
+        except Exception as e:
+            print(f"Could not save handoff: {e}", flush=True)
+    wait_for_listeners(DRAIN_DEADLINE)
+    # Ending the transcoders lets every relay finish its response properly
+    with ENCODERS_LOCK:
+        graphs = list(GRAPHS.values())
+    for graph in graphs:
+        graph['reaped'] = graph['reaped'] or "server restarting"
+        proc = graph['process']
+        if proc and proc.poll() is None:
+            proc.terminate()
+    print(f"Drained {len(graphs)} transcoders", flush=True)
+    # Not only for the development server: listeners taken over from a
+    # predecessor are relayed by our own threads, which gunicorn doesn't wait for
+    wait_for_listeners(time.monotonic() + 2)
+    if exit_when_done:
+        os._exit(0)
+
+def wait_for_listeners(deadline):
+    while time.monotonic() < deadline:
+        with SESSIONS_LOCK:
+            if not STREAM_SESSIONS:
+                return
+        time.sleep(0.1)
+
+def install_drain_handler():
+    """Chain a drain in front of whatever SIGTERM handler is installed: gunicorn's
+    graceful worker exit, or the default under the development server, where the
+    drain thread exits the process itself. Handlers can only be set from the main
+    thread, which is where gunicorn loads the app."""
+    if threading.current_thread() is not threading.main_thread():
+        return
+    previous = signal.getsignal(signal.SIGTERM)
+
+    def handle_sigterm(signum, frame):
+        global DRAIN_DEADLINE
+        if DRAIN_DEADLINE is None:
+            DRAIN_DEADLINE = time.monotonic() + DRAIN_TIMEOUT
+            print(f"SIGTERM: draining for up to {DRAIN_TIMEOUT:.0f}s", flush=True)
+            # Locks and file writes stay out of the signal handler itself. Not a
+            # daemon: the worker must not exit halfway through a handoff.
+            threading.Thread(target=drain, args=(not callable(previous),)).start()
+        if callable(previous):
+            previous(signum, frame)
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+# ── Profiling ─────────────────────────────────────────────────────────────────
+# Opt-in (PROFILER_ENABLED=1) sampling profiler for finding hot paths in
+# production: /api/debug/profile?seconds=N snapshots every thread's stack each
+# PROFILE_INTERVAL seconds and returns collapsed stacks ("thread;file:func;... n"),
+# the input format of flamegraph.pl and speedscope. It answers private addresses
+# only, runs one capture at a time, and holds its request thread for the capture.
+PROFILER_ENABLED = os.getenv('PROFILER_ENABLED', '0') == '1'
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', '0.01'))
+PROFILE_MAX_SECONDS = 60
+PROFILE_LOCK = threading.Lock()
+
+def sample_stacks(seconds, interval):
+    """Return (samples taken, {collapsed stack: count}) over `seconds`."""
+    counts = {}
+    samples = 0
+    me = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{getattr(code, 'co_qualname', code.co_name)}")
+                frame = frame.f_back
+            key = ';'.join([names.get(ident, str(ident))] + stack[::-1])
+            counts[key] = counts.get(key, 0) + 1
+        samples += 1
+        time.sleep(interval)
+    return samples, counts
+
+# ── Relay ─────────────────────────────────────────────────────────────────────
+# Moves a listener's audio from its output ring to the client. Reads land in one
+# preallocated buffer and the chunk size adapts to the backlog: a read that fills
+# the chunk doubles it, one that comes back mostly empty halves it. Under gunicorn
+# the first chunk goes out via WSGI (committing the status line and headers) and
+# the rest bypasses WSGI entirely: sendall straight from the buffer, framed to
+# match the chunked encoding gunicorn chose for the response. Every listener of
+# an output reads the same ring, so there is no per-listener pipe to splice from.
+RELAY_CHUNK_MIN = int(os.getenv('RELAY_CHUNK_MIN', '4096'))
+RELAY_CHUNK_MAX = max(RELAY_CHUNK_MIN, int(os.getenv('RELAY_CHUNK_MAX', '65536')))
+RELAY_DIRECT = os.getenv('RELAY_DIRECT', '1') != '0'
+MSG_MORE = getattr(socket, 'MSG_MORE', 0)
+
+def next_chunk_size(size, n):
+    if n >= size:
+        return min(size * 2, RELAY_CHUNK_MAX)
+    if n < size // 4:
+        return max(size // 2, RELAY_CHUNK_MIN)
+    return size
+
+def note_relay_in(sess, n):
+    sess['bytes_in'] += n
+    sess['last_output'] = time.monotonic()
+
+def note_relay_out(sess, n):
+    sess['bytes_out'] += n
+    sess['last_write'] = time.monotonic()
+
+def send_to_socket(source, view, sock, sess, chunked):
+    size = RELAY_CHUNK_MIN
+    while True:
+        n = source.readinto(view[:size])
+        if not n:
+            return
+        note_relay_in(sess, n)
+        if chunked:
+            sock.sendall(b'%X\r\n' % n, MSG_MORE)
+        sock.sendall(view[:n], MSG_MORE if chunked else 0)
+        if chunked:
+            sock.sendall(b'\r\n')
+        note_relay_out(sess, n)
+        size = next_chunk_size(size, n)
+
+def relay_stream(source, sess, sock=None, chunked=True):
+    """Relay `source` (anything with readinto(), such as a RingReader) until it
+    reads 0. Without `sock`, every chunk is yielded for WSGI; with it, only the
+    first is and the remainder is written to the socket directly. Byte-for-byte
+    the output is identical."""
+    buf = bytearray(RELAY_CHUNK_MAX)
+    view = memoryview(buf)
+    size = RELAY_CHUNK_MIN
+
+    n = source.readinto(view[:size])
+    if not n:
+        return
+    note_relay_in(sess, n)
+    yield bytes(view[:n])
+    note_relay_out(sess, n)
+    size = next_chunk_size(size, n)
+
+    if sock is not None:
+        sess['direct'] = True  # From here on the listener can be handed over
+        send_to_socket(source, view, sock, sess, chunked)
+        return
+
+    while True:
+        n = source.readinto(view[:size])
+        if not n:
+            return
+        note_relay_in(sess, n)
+        yield bytes(view[:n])
+        note_relay_out(sess, n)
+        size = next_chunk_size(size, n)
+
+# ── Output rings ──────────────────────────────────────────────────────────────
+# Each encoder output keeps its latest bytes in a ring that every listener reads
+# at its own position. Positions are absolute byte counts since the ring was
+# created; byte p lives at p % capacity while p >= head - capacity. The writer
+# never waits for a listener: one output feeds every listener of the station, so
+# holding it back for a slow reader would silence all the others. A listener more
+# than the ring's length behind is lapped and jumps to live, as the timeshift
+# store does. The ring holds OUTPUT_BUFFER_SECONDS of audio, which is how far a
+# listener may fall behind (a slow link, a brief stall) without losing any.
+OUTPUT_BUFFER_SECONDS = float(os.getenv('OUTPUT_BUFFER_SECONDS', '10'))
+
+def new_ring(view, capacity, bytes_per_sec):
+    return {
+        "view": view, "capacity": capacity, "bytes_per_sec": bytes_per_sec, "head": 0,
+        "cond": threading.Condition()  # Readers wait on it for data
+    }
+
+def ring_write(ring, data):
+    n = len(data)
+    capacity = ring['capacity']
+    with ring['cond']:
+        if n > capacity:
+            ring['head'] += n - capacity
+            data, n = data[-capacity:], capacity
+        start = ring['head'] % capacity
+        first = min(n, capacity - start)
+        ring['view'][start:start + first] = data[:first]
+        if first < n:
+            ring['view'][:n - first] = data[first:]
+        ring['head'] += n
+        ring['cond'].notify_all()
+
+class RingReader:
+    """File-like reader over a ring, from `position` or else from live. readinto()
+    blocks for new data the way a pipe read would and returns 0 once caught up
+    with an output that has stopped, so relay_stream() can drive it. An Ogg
+    reader first gets the output's header pages and only starts on a page. A
+    reader for listener `sess` also returns 0 once the listener is being handed
+    to another worker, leaving its position where the successor picks it up."""
+
+    def __init__(self, enc, ring, position=None, sess=None):
+        self.enc = enc
+        self.ring = ring
+        self.sess = sess
+        self.closed = False
+        self.aligned = enc['ogg'] is None
+        self.header_sent = 0
+        with ring['cond']:
+            self.position = ring['head'] if position is None else position
+
+    def lapped(self):
+        """Where to resume after the writer overwrote our position."""
+        return self.ring['head']
+
+    def readinto(self, view):
+        ring = self.ring
+        capacity = ring['capacity']
+        with ring['cond']:
+            while True:
+                if self.sess is not None and self.sess.get('handoff'):
+                    return 0
+                if self.position < ring['head'] - capacity:
+                    self.position = self.lapped()
+                    self.aligned = self.enc['ogg'] is None
+                if not self.aligned:
+                    self.position = find_ogg_page(ring, self.position)
+                    self.aligned = True
+                if self.position < ring['head']:
+                    break
+                if self.enc['closing']:
+                    return 0
+                ring['cond'].wait(timeout=1)
+            # Header pages are captured before the first page reaches any ring
+            header = self.enc['ogg'] and self.enc['ogg']['header']
+            if header and self.header_sent < len(header):
+                n = min(len(view), len(header) - self.header_sent)
+                view[:n] = header[self.header_sent:self.header_sent + n]
+                self.header_sent += n
+                return n
+            start = self.position % capacity
+            n = min(len(view), ring['head'] - self.position, capacity - start)
+            view[:n] = ring['view'][start:start + n]
+            self.position += n
+        return n
+
+    def close(self):
+        self.closed = True
+
+# ── Timeshift ─────────────────────────────────────────────────────────────────
+# Optional rolling record of each running encoder: a fixed-size, memory-mapped
+# circular file in cache/ holding the last TIMESHIFT_MINUTES. Listeners asking for
+# ?offset=-N read from the shared mapping at their own position instead of from
+# the output's live ring. The store is a ring too, and laps its readers the same
+# way. Total size is capped by TIMESHIFT_MAX_MB, evicting
+# the least recently used idle station first.
+TIMESHIFT_MINUTES = float(os.getenv('TIMESHIFT_MINUTES', '0'))
+TIMESHIFT_MAX_MB = int(os.getenv('TIMESHIFT_MAX_MB', '256'))
+TIMESHIFT_STORES = {}  # Map (video_id, codec, bitrate) to store record
+TIMESHIFT_LOCK = threading.Lock()
+
+def timeshift_path(key):
+    video_id, codec, bitrate = key
+    return os.path.join(CACHE_DIR, f"timeshift_{video_id}_{codec}_{bitrate}k.buf")
+
+def clear_stale_timeshift():
+    """Positions live only in memory, so buffers left by a previous run are junk."""
+    for name in os.listdir(CACHE_DIR):
+        if name.startswith('timeshift_') and name.endswith('.buf'):
+            try:
+                os.remove(os.path.join(CACHE_DIR, name))
+            except OSError:
+                pass
+
+def close_timeshift_store(store):
+    store['view'].release()
+    store['mm'].close()
+    store['file'].close()
+    try:
+        os.remove(store['path'])
+    except OSError:
+        pass
+
+def acquire_timeshift_store(video_id, codec, bitrate):
+    """Get or create the store for (video_id, codec, bitrate) and mark it in use.
+    Returns None when timeshift is off or the disk cap can't fit another station."""
+    if TIMESHIFT_MINUTES <= 0:
+        return None
+    key = (video_id, codec, bitrate)
+    bytes_per_sec = bitrate * 125
+    capacity = int(TIMESHIFT_MINUTES * 60 * bytes_per_sec)
+    limit = TIMESHIFT_MAX_MB * 1024 * 1024
+    with TIMESHIFT_LOCK:
+        store = TIMESHIFT_STORES.get(key)
+        if store:
+            store['users'] += 1
+            store['last_used'] = time.monotonic()
+            return store
+
+        used = sum(s['capacity'] for s in TIMESHIFT_STORES.values())
+        idle = sorted((s for s in TIMESHIFT_STORES.values() if not s['users']), key=lambda s: s['last_used'])
+        while used + capacity > limit and idle:
+            victim = idle.pop(0)
+            print(f"[{victim['key'][0]}] Evicting timeshift buffer ({victim['capacity'] // 1024} KB)", flush=True)
+            del TIMESHIFT_STORES[victim['key']]
+            close_timeshift_store(victim)
+            used -= victim['capacity']
+        if used + capacity > limit:
+            print(f"[{video_id}] Timeshift cap reached, recording skipped", flush=True)
+            return None
+
+        try:
+            path = timeshift_path(key)
+            f = open(path, 'w+b')
+            f.truncate(capacity)  # Sparse; blocks are allocated as they're written
+            mm = mmap.mmap(f.fileno(), capacity)
+        except (OSError, ValueError) as e:
+            print(f"[{video_id}] Could not create timeshift buffer: {e}", flush=True)
+            return None
+        store = TIMESHIFT_STORES[key] = dict(
+            new_ring(memoryview(mm), capacity, bytes_per_sec),
+            key=key, path=path, file=f, mm=mm, users=1, last_used=time.monotonic()
+        )
+        return store
+
+def release_timeshift_store(store):
+    with TIMESHIFT_LOCK:
+        store['users'] -= 1
+        store['last_used'] = time.monotonic()
+    with store['cond']:
+        store['cond'].notify_all()
+
+def timeshift_seconds(store):
+    return int(min(store['head'], store['capacity']) / store['bytes_per_sec'])
+
+class TimeshiftReader(RingReader):
+    """Reader over a timeshift store, starting `offset` seconds behind live (or
+    at `position`). Once lapped it skips forward to the oldest retained data."""
+
+    def __init__(self, enc, offset, sess=None, position=None):
+        store = enc['timeshift']
+        with TIMESHIFT_LOCK:
+            store['users'] += 1
+        with store['cond']:
+            oldest = max(0, store['head'] - store['capacity'])
+            if position is None:
+                position = store['head'] + int(offset * store['bytes_per_sec'])
+            position = max(oldest, position)
+            self.offset = (position - store['head']) / store['bytes_per_sec']
+        super().__init__(enc, store, position, sess)
+
+    def lapped(self):
+        # Paused longer than the buffer holds; resume a second inside it
+        store = self.ring
+        return min(store['head'], store['head'] - store['capacity'] + store['bytes_per_sec'])
+
+    def readinto(self, view):
+        n = super().readinto(view)
+        self.ring['last_used'] = time.monotonic()
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            release_timeshift_store(self.ring)
+
+# ── Source selection ──────────────────────────────────────────────────────────
+# `ba/b` falls back to a combined audio+video format for most live streams, so
+# ffmpeg downloads video only to discard it. Instead each station's format list is
+# fetched once (yt-dlp -J, shared with the availability check) and cached, and each
+# station's transcoder picks the cheapest format that still carries audio at or
+# above its highest output bitrate: audio-only when offered, else the cheapest
+# combined variant whose audio rate is known to be enough. yt-dlp leaves abr unset
+# on live HLS variants, so those come from HLS_ITAG_ABR; with no rate known at all
+# the choice is left to yt-dlp's `ba/b` as before. While a format's signed URL is
+# still fresh it's used directly, skipping a second yt-dlp round-trip. Upstream
+# bytes are counted from ffmpeg's per-request "Statistics: N bytes read" lines —
+# one per segment for HLS live streams.
+FORMAT_MANIFEST_TTL = float(os.getenv('FORMAT_MANIFEST_TTL', '21600'))
+FORMAT_URL_MARGIN = 600  # Re-resolve a signed URL this many seconds before it expires
+PLAYABLE_PROTOCOLS = ('http', 'https', 'm3u8', 'm3u8_native')
+FORMAT_MANIFESTS = {}  # Map video_id to cached format list
+SOURCE_CHOICES = {}  # Map video_id to the chosen format, for /api/stats
+MANIFEST_LOCK = threading.Lock()
+EXPIRE_RE = re.compile(r'expire[/=](\d+)')
+AVIO_STATS_RE = re.compile(r'Statistics: (\d+) bytes read')
+# With level+ logging the level tag follows any "[demuxer @ 0x…] " context
+LOG_ERROR_RE = re.compile(r'(?:^|\] )\[(?:error|fatal|panic)\] ')
+# Audio kbps of YouTube's HLS itags, which yt-dlp lists without an abr
+HLS_ITAG_ABR = {
+    '151': 24, '91': 48, '92': 48, '132': 48, '93': 128, '94': 128,
+    '300': 128, '301': 128, '95': 256, '96': 256
+}
+
+def fetch_format_manifest(video_id):
+    """Run yt-dlp -J and keep only formats ffmpeg can open that carry audio.
+    Returns None if the station can't be resolved."""
+    result = subprocess.run(
+        ['yt-dlp', '-J', '--no-playlist', build_youtube_url(video_id)],
+        capture_output=True, text=True, timeout=30
+    )
+    if result.returncode != 0:
+        return None
+    info = json.loads(result.stdout)
+    formats = []
+    for f in info.get('formats') or []:
+        if f.get('acodec') in (None, 'none') or f.get('protocol') not in PLAYABLE_PROTOCOLS or not f.get('url'):
+            continue
+        audio_only = f.get('vcodec') in (None, 'none')
+        formats.append({
+            "format_id": f.get('format_id'),
+            "protocol": f.get('protocol'),
+            "audio_only": audio_only,
+            # yt-dlp often leaves abr unset on audio-only formats; there tbr is the audio rate
+            "abr": f.get('abr') or (f.get('tbr') if audio_only else None)
+                   or HLS_ITAG_ABR.get(str(f.get('format_id')).split('-')[0]),
+            "tbr": f.get('tbr'),
+            "url": f['url']
+        })
+    manifest = {"fetched": time.time(), "is_live": bool(info.get('is_live')), "formats": formats}
+    with MANIFEST_LOCK:
+        FORMAT_MANIFESTS[video_id] = manifest
+    return manifest
+
+def get_format_manifest(video_id, refresh=False):
+    with MANIFEST_LOCK:
+        manifest = FORMAT_MANIFESTS.get(video_id)
+    if manifest and not refresh and time.time() - manifest['fetched'] < FORMAT_MANIFEST_TTL:
+        return manifest
+    return fetch_format_manifest(video_id)
+
+def select_source_format(formats, bitrate):
+    """Cheapest format whose audio meets `bitrate` kbps, preferring audio-only.
+    With nothing fast enough, the best audio on offer; with no audio rate known,
+    None, since the cheapest variant may carry the worst audio."""
+    audio_only = [f for f in formats if f['audio_only']]
+    candidates = audio_only or formats
+    if not candidates:
+        return None
+    rated = [f for f in candidates if f['abr']]
+    enough = [f for f in rated if f['abr'] >= bitrate]
+    if enough:
+        return min(enough, key=lambda f: (f['abr'], f['tbr'] or 0))
+    if rated:
+        return max(rated, key=lambda f: (f['abr'], -(f['tbr'] or 0)))
+    return None
+
+def url_is_fresh(url, fetched):
+    m = EXPIRE_RE.search(url)
+    if m:
+        return int(m.group(1)) - time.time() > FORMAT_URL_MARGIN
+    return time.time() - fetched < FORMAT_URL_MARGIN
+
+def resolve_source(graph, bitrate):
+    """Return the direct URL for the graph's station, recording the choice.
+    Falls back to the old `ba/b` selector if the format list is unavailable."""
+    video_id = graph['video_id']
+    try:
+        manifest = get_format_manifest(video_id)
+    except (subprocess.TimeoutExpired, ValueError) as e:
+        print(f"[{graph['id']}] Format list failed: {e}", flush=True)
+        manifest = None
+    chosen = select_source_format(manifest['formats'], bitrate) if manifest else None
+
+    if chosen and url_is_fresh(chosen['url'], manifest['fetched']):
+        direct_url = chosen['url']
+    else:
+        selector = f"{chosen['format_id']}/ba/b" if chosen else 'ba/b'
+        url_proc = subprocess.run(
+            ['yt-dlp', '-g', '-f', selector, build_youtube_url(video_id)],
+            capture_output=True, text=True
+        )
+        if url_proc.returncode != 0:
+            print(f"[{graph['id']}] yt-dlp error: {url_proc.stderr}", flush=True)
+            return None
+        # A combined selector prints one URL per stream; ffmpeg wants the first
+        direct_url = url_proc.stdout.strip().split('\n')[0]
+
+    choice = {
+        "bitrate": bitrate,
+        "format_id": chosen['format_id'] if chosen else 'ba/b',
+        "protocol": chosen['protocol'] if chosen else None,
+        "audio_only": chosen['audio_only'] if chosen else None,
+        "abr": chosen['abr'] if chosen else None,
+        "tbr": chosen['tbr'] if chosen else None,
+        "is_live": manifest['is_live'] if manifest else None,
+        "upstream_rate": 0
+    }
+    with MANIFEST_LOCK:
+        SOURCE_CHOICES[video_id] = choice
+    graph['source'] = choice
+    print(f"[{graph['id']}] Source format {choice['format_id']} (abr={choice['abr']}, tbr={choice['tbr']})", flush=True)
+    return direct_url
+
+def read_graph_log(graph, proc):
+    """Drain ffmpeg's stderr: tally upstream bytes and surface real errors."""
+    for line in pipe_lines(proc.stderr.fileno(), graph):
+        m = AVIO_STATS_RE.search(line)
+        if m:
+            graph['upstream_bytes'] += int(m.group(1))
+        elif LOG_ERROR_RE.search(line):
+            print(f"[{graph['id']}] ffmpeg: {line.rstrip()}", flush=True)
+    if not graph['handoff']:
+        proc.stderr.close()
+
+# ── Ogg pages ─────────────────────────────────────────────────────────────────
+# An Ogg Opus stream only decodes from its start: its first pages carry OpusHead
+# and OpusTags, and decoders sync on page boundaries. So an Ogg output reaches its
+# rings in whole pages only, its header pages are kept aside and replayed to each
+# listener (live or timeshift) before its first page, and a reader starting at an
+# arbitrary byte skips to the next page. When an output is re-created while its
+# timeshift store still holds the stream, the new encoder's header pages are
+# dropped and its pages renumbered into the stored logical stream (serial, page
+# sequence, granule position, CRC), so timeshift listeners hear one continuous
+# stream instead of a chained one. End-of-stream flags are cleared for the same
+# reason.
+OGG_MAX_PAGE = 27 + 255 + 255 * 255
+
+def ogg_crc_entry(i):
+    r = i << 24
+    for _ in range(8):
+        r = ((r << 1) ^ 0x04C11DB7) if r & 0x80000000 else r << 1
+    return r & 0xFFFFFFFF
+
+OGG_CRC_TABLE = [ogg_crc_entry(i) for i in range(256)]
+
+def ogg_crc(page):
+    crc = 0
+    for b in page:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ OGG_CRC_TABLE[(crc >> 24) ^ b]
+    return crc
+
+def ogg_page_length(buf, start):
+    """Length of the page at `start`, or None if it isn't all in `buf` yet."""
+    if len(buf) - start < 27:
+        return None
+    body = 27 + buf[start + 26]
+    if len(buf) - start < body:
+        return None
+    length = body + sum(buf[start + 27:start + body])
+    return length if len(buf) - start >= length else None
+
+def find_ogg_page(ring, position):
+    """First page boundary at or after `position`. The head always is one, since
+    rings are only ever written whole pages."""
+    capacity = ring['capacity']
+    n = min(ring['head'] - position, OGG_MAX_PAGE + 4)
+    start = position % capacity
+    first = min(n, capacity - start)
+    window = bytes(ring['view'][start:start + first]) + bytes(ring['view'][:n - first])
+    i = window.find(b'OggS')
+    # Version 0 and a valid header type, to skip "OggS" inside page data
+    while i >= 0 and i + 5 < len(window) and (window[i + 4] != 0 or window[i + 5] > 7):
+        i = window.find(b'OggS', i + 1)
+    return position + i if i >= 0 else ring['head']
+
+def new_ogg_stream():
+    """Continuity state of an Ogg output, shared with its timeshift store so a
+    re-created output carries on the stream the store already holds."""
+    return {"header": None, "serial": None, "sequence": 0, "granule": 0}
+
+def ogg_listener_page(stream, run, page):
+    """What listeners get for one page of this encoder's output (`run`): nothing
+    for a header page, else the page, renumbered if this isn't the stream's
+    first encoder."""
+    granule = int.from_bytes(page[6:14], 'little', signed=True)
+    if run['header'] is not None:
+        if granule in (0, -1):
+            if page[5] & 0x02:
+                body = 27 + page[26]  # OpusHead: pre-skip is bytes 10-11
+                run['pre_skip'] = int.from_bytes(page[body + 10:body + 12], 'little')
+            run['header'] += page
+            return b''
+        if stream['header'] is None:
+            stream['header'] = bytes(run['header'])
+        run['header'] = None
+        if stream['serial'] is None:
+            stream['serial'] = bytes(page[14:18])
+        else:
+            run['shift'] = stream['granule'] - run['pre_skip']
+    if run['shift'] is not None or page[5] & 0x04:
+        page[5] &= 0xFF ^ 0x04
+        if run['shift'] is not None:
+            page[14:18] = stream['serial']
+            page[18:22] = ((stream['sequence'] + 1) & 0xFFFFFFFF).to_bytes(4, 'little')
+            if granule != -1:
+                page[6:14] = (granule + run['shift']).to_bytes(8, 'little', signed=True)
+        page[22:26] = bytes(4)
+        page[22:26] = ogg_crc(page).to_bytes(4, 'little')
+    stream['sequence'] = int.from_bytes(page[18:22], 'little')
+    if granule != -1:
+        stream['granule'] = int.from_bytes(page[6:14], 'little', signed=True)
+    return page
+
+def ogg_listener_pages(stream, run, data):
+    """Split ffmpeg output into pages, buffering a partial one for next time."""
+    buf = run['buf']
+    buf += data
+    out = bytearray()
+    pos = 0
+    while True:
+        start = buf.find(b'OggS', pos)
+        if start < 0:
+            pos = max(pos, len(buf) - 3)
+            break
+        length = ogg_page_length(buf, start)
+        if length is None:
+            pos = start
+            break
+        out += ogg_listener_page(stream, run, buf[start:start + length])
+        pos = start + length
+    del buf[:pos]
+    return out
+
+# ── Encoders ──────────────────────────────────────────────────────────────────
+# One decode per station: a decoder ffmpeg reads the source and writes raw PCM,
+# which the graph thread copies to one encoder ffmpeg per (codec, bitrate) that
+# listeners ask for. A pump thread per output copies its encoder's output into the
+# output's ring, which each listener relays from at its own position. Encoders
+# start and stop on their own, so a listener asking for a new tier, or the last
+# one of a tier leaving, doesn't touch the station's other outputs. Only an output
+# that needs a better source than the decoder is reading restarts the decoder; the
+# encoders carry on across that, so their listeners hear a short gap in one
+# unbroken stream. Sources that aren't live are read at their native rate (-re),
+# so a video ID can't be encoded faster than it plays.
+BITRATE_TIERS = sorted({int(b) for b in os.getenv('BITRATE_TIERS', '48,64,128,192,320').split(',') if b.strip()})
+DEFAULT_BITRATE = int(os.getenv('DEFAULT_BITRATE', '128'))
+if DEFAULT_BITRATE not in BITRATE_TIERS:
+    BITRATE_TIERS = sorted(set(BITRATE_TIERS) | {DEFAULT_BITRATE})
+# Outputs are joined mid-stream, so MP3 goes out without an ID3 tag or Xing
+# frame at its start, and Ogg is handled page-wise.
+CODECS = {
+    "mp3": {"encoder": "libmp3lame", "format": "mp3", "mimetype": "audio/mpeg", "ext": "mp3",
+            "options": ['-id3v2_version', '0', '-write_xing', '0'], "ogg": False},
+    "aac": {"encoder": "aac", "format": "adts", "mimetype": "audio/aac", "ext": "aac",
+            "options": [], "ogg": False},
+    "opus": {"encoder": "libopus", "format": "ogg", "mimetype": "audio/ogg", "ext": "ogg",
+             "options": [], "ogg": True}
+}
+CODEC_BY_EXT = {c['ext']: name for name, c in CODECS.items()}
+# Decoded audio as the encoders take it: Opus only encodes 48 kHz, and one format
+# for every encoder is what lets them share the decode.
+PCM_RATE = 48000
+PCM_CHANNELS = 2
+PCM_FRAME = 2 * PCM_CHANNELS  # Bytes per sample frame (s16le)
+PCM_CHUNK = 65536
+PCM_HOLD = 0.1  # A PCM write blocked this long (seconds) held the decoder back
+# Real-time check on ffmpeg's -progress reports: a station whose media time grows
+# slower than PROGRESS_MIN_SPEED x wall time over PROGRESS_WINDOW seconds is
+# flagged in /api/stats, as its listeners will be hearing dropouts.
+PROGRESS_MIN_SPEED = float(os.getenv('PROGRESS_MIN_SPEED', '0.97'))
+PROGRESS_WINDOW = float(os.getenv('PROGRESS_WINDOW', '20'))
+GRAPHS = {}  # Map video_id to the station's transcode graph
+ENCODERS = {}  # Map (video_id, codec, bitrate) to shared output record
+ENCODERS_LOCK = threading.Lock()  # Guards both, and every graph's outputs
+
+def parse_bitrate(value):
+    """Return the tier (kbps) for a `br` value such as "64" or "64k", or None."""
+    value = str(value or '').strip().lower().rstrip('k')
+    if not value.isdigit():
+        return None
+    bitrate = int(value)
+    return bitrate if bitrate in BITRATE_TIERS else None
+
+# Per-renderer cast defaults, e.g. "Kitchen Speaker=64,uuid:1234-abcd=320". Keys
+# match a device's UDN exactly or its friendly name case-insensitively.
+def parse_device_bitrates(spec):
+    bitrates = {}
+    for entry in spec.split(','):
+        device, _, br = entry.rpartition('=')
+        if device.strip() and parse_bitrate(br):
+            bitrates[device.strip().lower()] = parse_bitrate(br)
+        elif entry.strip():
+            print(f"Ignoring DLNA_BITRATES entry '{entry}' (allowed tiers: {BITRATE_TIERS})", flush=True)
+    return bitrates
+
+DLNA_BITRATES = parse_device_bitrates(os.getenv('DLNA_BITRATES', ''))
+
+def dlna_default_bitrate(udn, name):
+    for key in (udn, name):
+        if key and key.lower() in DLNA_BITRATES:
+            return DLNA_BITRATES[key.lower()]
+    return DEFAULT_BITRATE
+
+def stop_process(proc):
+    proc.terminate()
+    try:
+        proc.wait(timeout=1)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait() # Reap zombie process
+    except:
+        proc.kill()
+        proc.wait()
+
+    if proc.stdout:
+        proc.stdout.close()
+
+def close_output(enc):
+    """Wake an output's listeners so they see it closing, and let go of its
+    timeshift store. Called once, by whoever set enc['closing']."""
+    ring = enc['ring']
+    with ring['cond']:
+        ring['cond'].notify_all()
+    # Also wakes timeshift readers so they drain and see the output closing
+    if enc['timeshift']:
+        release_timeshift_store(enc['timeshift'])
+
+def pipe_poller(pipe):
+    poller = select.poll()
+    poller.register(pipe, select.POLLIN)
+    return poller
+
+def wait_readable(poller, graph):
+    """Wait for the pipe behind `poller` to have data (or EOF). False instead once
+    the graph is being handed to another worker: every thread reading a graph's
+    pipes stops between reads, so the successor carries on from the next byte."""
+    while not graph['handoff']:
+        if poller.poll(500):
+            return True
+    return False
+
+def pipe_lines(fd, graph):
+    """Text lines from one of ffmpeg's log pipes until EOF or a handoff. Unlike
+    iterating a file object, nothing is read ahead that the successor would miss."""
+    poller = pipe_poller(fd)
+    pending = b''
+    while wait_readable(poller, graph):
+        data = os.read(fd, 65536)
+        if not data:
+            break
+        lines = (pending + data).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line.decode(errors='replace') + '\n'
+    if pending and not graph['handoff']:
+        yield pending.decode(errors='replace')
+
+def build_decoder_command(direct_url, progress_fd, paced=False):
+    """One input and one audio decode, to raw PCM on stdout. -map keeps ffmpeg
+    from also decoding the video of a combined source. Verbose logging is only
+    for the per-request byte statistics; everything else below [error] is
+    dropped. Progress goes to its own pipe instead of stderr."""
+    command = [
+        'ffmpeg', '-loglevel', 'level+verbose', '-nostats',
+        '-progress', f"pipe:{progress_fd}"
+    ]
+    if paced:
+        command.append('-re')
+    command += [
+        '-i', direct_url, '-map', '0:a:0',
+        '-f', 's16le', '-ar', str(PCM_RATE), '-ac', str(PCM_CHANNELS),
+        '-flush_packets', '1', 'pipe:1'
+    ]
+    return command
+
+def build_encoder_command(enc):
+    """Raw PCM in on stdin, one codec and bitrate out on stdout."""
+    codec = CODECS[enc['codec']]
+    return [
+        'ffmpeg', '-loglevel', 'level+error', '-nostats',
+        '-f', 's16le', '-ar', str(PCM_RATE), '-ac', str(PCM_CHANNELS), '-i', 'pipe:0',
+        '-f', codec['format'], '-acodec', codec['encoder'], '-ab', f"{enc['bitrate']}k",
+        '-flush_packets', '1', *codec['options'], 'pipe:1'
+    ]
+
+def pump_output(graph, enc, proc):
+    """Relay one encoder's output to the output's listeners until it exits. An
+    encoder that dies while its output is still in use takes the output down
+    with it; its listeners see EOF and reconnect. Stopped by a handoff, it
+    leaves the encoder running for the successor."""
+    view = memoryview(bytearray(RELAY_CHUNK_MAX))
+    run = enc['run']  # Ogg page state of this encoder's output so far
+    poller = pipe_poller(proc.stdout)
+    try:
+        while wait_readable(poller, graph):
+            n = proc.stdout.readinto(view)
+            if not n:
+                break
+            enc['bytes_in'] += n
+            enc['last_output'] = graph['last_output'] = time.monotonic()
+            if enc['closing']:
+                continue  # Closed output, encoder flushing its last input
+            data = view[:n]
+            if enc['ogg'] is not None:
+                data = ogg_listener_pages(enc['ogg'], run, data)
+                if not data:
+                    continue
+            if enc['timeshift']:
+                ring_write(enc['timeshift'], data)
+                enc['timeshift']['last_used'] = time.monotonic()
+            ring_write(enc['ring'], data)
+        else:
+            return  # Handed over
+    except Exception as e:
+        print(f"[{enc['id']}] Output error: {e}", flush=True)
+    stop_process(proc)  # Just reaps an encoder that has already exited
+    for line in proc.stderr.read().decode(errors='replace').splitlines():
+        if LOG_ERROR_RE.search(line):
+            print(f"[{enc['id']}] ffmpeg: {line}", flush=True)
+    proc.stderr.close()
+    if not enc['closing']:
+        print(f"[{enc['id']}] Encoder exited unexpectedly (code {proc.returncode})", flush=True)
+        drop_output(enc)
+
+def progress_number(value):
+    """Parse a -progress value such as "1.02x", "128.0kbits/s" or "N/A"."""
+    try:
+        return float(value.rstrip('x').replace('kbits/s', ''))
+    except ValueError:
+        return None
+
+def read_graph_progress(graph, fd):
+    """Parse ffmpeg's -progress reports (key=value lines, each report closed by a
+    progress= line) into graph['progress']. ffmpeg's own speed is averaged since
+    start and HLS input arrives a segment at a time, so the real-time check
+    compares media time gained against wall time over PROGRESS_WINDOW seconds.
+    A report without a media time (N/A before the first packet) is skipped. The
+    decoder can't run ahead of an encoder whose input is full, so after such a
+    hold (see feed_encoders) the window starts over rather than count the hold
+    as the decoder falling behind."""
+    report = {}
+    history = deque()
+    try:
+        for line in pipe_lines(fd, graph):
+            key, _, value = line.strip().partition('=')
+            if key != 'progress':
+                report[key] = value
+                continue
+            now = time.monotonic()
+            out_time_us = progress_number(report.get('out_time_us', ''))
+            if out_time_us is None:
+                report = {}
+                continue
+            out_time = out_time_us / 1e6
+            if history and graph['held_at'] >= history[-1][0]:
+                history.clear()
+            history.append((now, out_time))
+            while now - history[0][0] > PROGRESS_WINDOW:
+                history.popleft()
+            realtime = None
+            span = now - history[0][0]
+            if span >= PROGRESS_WINDOW / 2:
+                realtime = round((out_time - history[0][1]) / span, 2)
+            behind = realtime is not None and realtime < PROGRESS_MIN_SPEED
+            was_behind = bool(graph['progress'] and graph['progress']['behind'])
+            graph['progress'] = {
+                "speed": progress_number(report.get('speed', '')),
+                "realtime": realtime,
+                "out_time": round(out_time, 1),
+                "bitrate": progress_number(report.get('bitrate', '')),
+                "total_size": int(progress_number(report.get('total_size', '')) or 0),
+                "drop_frames": int(progress_number(report.get('drop_frames', '')) or 0),
+                "dup_frames": int(progress_number(report.get('dup_frames', '')) or 0),
+                "behind": behind
+            }
+            if behind and not was_behind:
+                print(f"[{graph['id']}] Transcode behind real time ({realtime}x)", flush=True)
+                with LOG_LOCK:
+                    ERROR_LOG.append(f"{datetime.now().strftime('%H:%M:%S')} - Behind real time {graph['id']}: {realtime}x")
+            report = {}
+    except Exception as e:
+        print(f"[{graph['id']}] Progress reader error: {e}", flush=True)
+    if not graph['handoff']:
+        os.close(fd)
+
+def write_all(pipe, data):
+    view = memoryview(data)
+    while view:
+        view = view[pipe.write(view):]
+
+def close_encoder_input(enc):
+    """End an encoder's input: it flushes what it has and exits."""
+    try:
+        enc['process'].stdin.close()
+    except OSError:
+        pass
+
+def feed_encoders(graph, proc):
+    """Copy the decoder's PCM to every started encoder of the graph until the
+    decoder exits. Only this thread writes or closes encoder inputs; an output
+    that has closed gets its input closed here. An encoder's input is kept on
+    whole sample frames: one started mid-stream joins at the next frame, and
+    after a decoder restart a partial frame is finished with silence. A write
+    that blocks means that encoder is behind; graph['held_at'] records it for
+    the real-time check. Returns False if it stopped for a handoff instead."""
+    view = memoryview(bytearray(PCM_CHUNK))
+    position = graph['pcm_read']  # Bytes from this decoder so far
+    poller = pipe_poller(proc.stdout)
+    while wait_readable(poller, graph):
+        n = proc.stdout.readinto(view)
+        if not n:
+            return True
+        with ENCODERS_LOCK:
+            done = [enc for enc in graph['encoders'] if enc['closing']]
+            for enc in done:
+                graph['encoders'].remove(enc)
+            encoders = list(graph['encoders'])
+        for enc in done:
+            close_encoder_input(enc)
+        for enc in encoders:
+            data = view[:n]
+            if enc['pcm_fed'] % PCM_FRAME != position % PCM_FRAME:
+                data = bytes(-enc['pcm_fed'] % PCM_FRAME) + bytes(data[-position % PCM_FRAME:])
+            started = time.monotonic()
+            try:
+                write_all(enc['process'].stdin, data)
+                enc['pcm_fed'] += len(data)
+            except (OSError, ValueError):
+                pass  # Encoder gone; its pump drops the output
+            if time.monotonic() - started > PCM_HOLD:
+                graph['held_at'] = time.monotonic()
+        position += n
+        graph['pcm_read'] = position
+    return False
+
+def start_graph_readers(graph, proc):
+    graph['log_thread'] = threading.Thread(target=read_graph_log, args=(graph, proc), daemon=True)
+    graph['progress_thread'] = threading.Thread(target=read_graph_progress, args=(graph, graph['progress_fd']), daemon=True)
+    graph['log_thread'].start()
+    graph['progress_thread'].start()
+
+def start_decoder(graph, outputs):
+    """Start the graph's decoder on the cheapest source good enough for every
+    output. Returns it, or None if the source couldn't be resolved."""
+    # 1. Pick and resolve the source
+    print(f"[{graph['id']}] Fetching YouTube URL...", flush=True)
+    direct_url = resolve_source(graph, max(enc['bitrate'] for enc in outputs))
+    if not direct_url:
+        with LOG_LOCK:
+            ERROR_LOG.append(f"{datetime.now().strftime('%H:%M:%S')} - yt-dlp Error: {graph['video_id']}")
+        return None
+
+    # 2. Decode it once, with progress reports on a pipe of their own
+    paced = bool(graph['source']) and graph['source']['is_live'] is False
+    progress_r, progress_w = os.pipe()
+    try:
+        proc = subprocess.Popen(
+            build_decoder_command(direct_url, progress_w, paced),
+            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            bufsize=0, pass_fds=[progress_w]
+        )
+    except Exception:
+        os.close(progress_r)
+        raise
+    finally:
+        os.close(progress_w)
+    graph['progress'] = None
+    graph['progress_fd'] = progress_r
+    graph['pcm_read'] = 0
+    with ENCODERS_LOCK:
+        graph['process'] = proc
+        graph['spawned'] = graph['last_output'] = time.monotonic()
+        stale = graph['closing'] or graph['dirty'] or not graph['outputs']
+    start_graph_readers(graph, proc)
+    if stale:
+        proc.terminate()  # Demand changed while we were starting up
+    print(f"[{graph['id']}] Decoder started for {', '.join(enc['id'] for enc in outputs)}", flush=True)
+    return proc
+
+def shut_down_graph(graph):
+    """Close every output of a graph that has stopped, end its encoders' input
+    and stop its decoder."""
+    with ENCODERS_LOCK:
+        if GRAPHS.get(graph['video_id']) is graph:
+            del GRAPHS[graph['video_id']]
+        graph['closing'] = True
+        outputs = [enc for enc in graph['outputs'].values() if not enc['closing']]
+        for enc in outputs:
+            enc['closing'] = True
+            if ENCODERS.get(enc['key']) is enc:
+                del ENCODERS[enc['key']]
+        encoders = list(graph['encoders'])
+        graph['encoders'].clear()
+    for enc in outputs:
+        close_output(enc)
+    for enc in encoders:
+        close_encoder_input(enc)
+    if graph['process']:
+        stop_process(graph['process'])
+    print(f"[{graph['id']}] Transcoder stopped", flush=True)
+
+def run_graph(graph):
+    """The graph thread: decode, fan out, and restart the decoder when an output
+    needs a better source. A graph adopted from a predecessor worker starts out
+    with its decoder already running; one handed on to a successor is left
+    running for it."""
+    proc = graph['process']
+    try:
+        while True:
+            if proc is None:
+                with ENCODERS_LOCK:
+                    outputs = list(graph['outputs'].values())
+                    graph['dirty'] = False
+                    if not outputs or graph['reaped']:
+                        graph['closing'] = True
+                        break
+                proc = start_decoder(graph, outputs)
+                if proc is None:
+                    return
+
+            # 3. Fan the decoded audio out to the encoders
+            graph['feeding'] = True
+            finished = feed_encoders(graph, proc)
+            graph['feeding'] = False
+            if not finished:
+                graph['parked'].set()
+                return
+            proc.wait()
+            graph['log_thread'].join()
+            with ENCODERS_LOCK:
+                if not graph['dirty'] or graph['reaped'] or graph['closing'] or graph['handoff']:
+                    graph['closing'] = True
+                    break
+            graph['restarts'] += 1
+            print(f"[{graph['id']}] Restarting decoder for a better source", flush=True)
+            proc = None
+    except Exception as e:
+        print(f"[{graph['id']}] Transcoder error: {e}", flush=True)
+        with LOG_LOCK:
+            ERROR_LOG.append(f"{datetime.now().strftime('%H:%M:%S')} - Stream Error: {str(e)[:50]}")
+    finally:
+        if not graph['parked'].is_set():
+            shut_down_graph(graph)
+
+def new_graph(video_id):
+    now = time.monotonic()
+    return {
+        "id": video_id, "video_id": video_id, "outputs": {}, "encoders": [],
+        "process": None, "closing": False, "dirty": False, "reaped": None,
+        "restarts": 0, "progress": None, "held_at": 0, "pcm_read": 0,
+        "source": None, "spawned": None, "upstream_bytes": 0,
+        "started": now, "last_output": now,
+        "sample_time": now, "sample_cpu": None, "spin_since": None,
+        "progress_fd": None, "log_thread": None, "progress_thread": None,
+        # Live handoff: feeding while the graph thread can park, handoff once it
+        # should, parked once it has
+        "feeding": False, "handoff": False, "parked": threading.Event()
+    }
+
+def source_upgrade_needed(graph, bitrate):
+    """Whether a new output at `bitrate` is worth restarting the decoder for: the
+    source it reads has less audio than that, and the station offers more."""
+    source = graph['source']
+    if not source or not source['abr'] or source['abr'] >= bitrate:
+        return False
+    with MANIFEST_LOCK:
+        manifest = FORMAT_MANIFESTS.get(graph['video_id'])
+    better = manifest and select_source_format(manifest['formats'], bitrate)
+    return bool(better and better['abr'] and better['abr'] > source['abr'])
+
+def start_encoder(enc):
+    """Start an output's encoder and the pump relaying it. The graph thread feeds
+    it from its next decoded chunk, or, if the graph stopped meanwhile, its input
+    is closed right away."""
+    graph = enc['graph']
+    proc = subprocess.Popen(
+        build_encoder_command(enc),
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=0
+    )
+    pump = threading.Thread(target=pump_output, args=(graph, enc, proc), daemon=True)
+    with ENCODERS_LOCK:
+        enc['process'] = proc
+        enc['pump'] = pump
+        running = not graph['closing']
+        if running:
+            graph['encoders'].append(enc)
+    if not running:
+        close_encoder_input(enc)
+    try:
+        pump.start()
+    except RuntimeError:
+        stop_process(proc)
+        raise
+
+def new_output(graph, codec, bitrate, timeshift):
+    """Create an output of `graph` and register it; the caller holds
+    ENCODERS_LOCK and starts its encoder."""
+    video_id = graph['video_id']
+    key = (video_id, codec, bitrate)
+    now = time.monotonic()
+    capacity = max(int(OUTPUT_BUFFER_SECONDS * bitrate * 125), 4 * RELAY_CHUNK_MAX)
+    enc = ENCODERS[key] = graph['outputs'][key] = {
+        "id": f"{video_id}@{codec}:{bitrate}k", "key": key, "graph": graph,
+        "video_id": video_id, "codec": codec, "bitrate": bitrate,
+        "subscribers": {}, "ring": new_ring(memoryview(bytearray(capacity)), capacity, bitrate * 125),
+        "closing": False, "ogg": None, "process": None, "pump": None, "pcm_fed": 0,
+        "run": {"buf": bytearray(), "header": bytearray(), "pre_skip": 0, "shift": None},
+        "timeshift": timeshift,
+        "started": now, "last_output": now, "bytes_in": 0, "rate": 0, "sample_bytes": 0
+    }
+    if CODECS[codec]['ogg']:
+        enc['ogg'] = timeshift.setdefault('ogg', new_ogg_stream()) if timeshift else new_ogg_stream()
+    return enc
+
+def detach_output(enc):
+    """Take an output out of service; the caller holds ENCODERS_LOCK and then
+    calls close_output(). Returns the station's decoder if that was its last
+    output, for the caller to stop."""
+    graph = enc['graph']
+    enc['closing'] = True
+    if ENCODERS.get(enc['key']) is enc:
+        del ENCODERS[enc['key']]
+    graph['outputs'].pop(enc['key'], None)
+    return None if graph['outputs'] else graph['process']
+
+def drop_output(enc):
+    with ENCODERS_LOCK:
+        if enc['closing']:
+            return
+        proc = detach_output(enc)
+    close_output(enc)
+    if proc and proc.poll() is None:
+        proc.terminate()
+
+def subscribe_encoder(video_id, codec, bitrate, session_key, sess, timeshift=False):
+    """Attach a listener to the shared output for (video_id, codec, bitrate),
+    starting its encoder (and the station's graph) if needed. Returns the output
+    and a live reader of its ring — or None for a timeshift listener on a
+    recording output, which reads the store instead and only holds the output
+    open."""
+    sub = {"sess": sess}
+    key = (video_id, codec, bitrate)
+    created = False
+    started = False
+    upgrade = None
+    with ENCODERS_LOCK:
+        enc = ENCODERS.get(key)
+        if enc is None:
+            graph = GRAPHS.get(video_id)
+            if graph is None or graph['closing']:
+                graph = GRAPHS[video_id] = new_graph(video_id)
+                created = True
+            elif source_upgrade_needed(graph, bitrate):
+                graph['dirty'] = True
+                upgrade = graph['process']
+            enc = new_output(graph, codec, bitrate, acquire_timeshift_store(video_id, codec, bitrate))
+            started = True
+        enc['subscribers'][session_key] = sub
+    sess['subscription'] = sub
+
+    reader = None
+    if not (timeshift and enc['timeshift']):
+        # An output that closed meanwhile just reads as EOF
+        reader = RingReader(enc, enc['ring'], sess=sess)
+    try:
+        if created:
+            threading.Thread(target=run_graph, args=(enc['graph'],), daemon=True).start()
+        if started:
+            start_encoder(enc)
+    except (OSError, RuntimeError):
+        if created:
+            with ENCODERS_LOCK:
+                enc['graph']['closing'] = True
+                if GRAPHS.get(video_id) is enc['graph']:
+                    del GRAPHS[video_id]
+        unsubscribe_encoder(enc, session_key)
+        if reader:
+            reader.close()
+        raise
+    if upgrade:
+        print(f"[{sess['id']}] Adding output {enc['id']}, restarting decoder for a better source", flush=True)
+        if upgrade.poll() is None:
+            upgrade.terminate()
+    elif started and not created:
+        print(f"[{sess['id']}] Adding output {enc['id']}", flush=True)
+    elif not started:
+        print(f"[{sess['id']}] Joined running encoder {enc['id']}", flush=True)
+    return enc, reader
+
+def unsubscribe_encoder(enc, session_key):
+    """Detach a listener. The last one out of an output stops its encoder; the
+    last output out stops the graph."""
+    proc = None
+    closed = False
+    with ENCODERS_LOCK:
+        enc['subscribers'].pop(session_key, None)
+        if not enc['subscribers'] and not enc['closing']:
+            proc = detach_output(enc)
+            closed = True
+    if closed:
+        close_output(enc)
+    # The graph thread sees ffmpeg exit and does the full shutdown and reaping
+    if proc and proc.poll() is None:
+        proc.terminate()
 
 def get_server_ip():
     """Get the local IP address of the server."""
@@ -97,7 +1602,7 @@ def get_server_ip():
 
 def discover_dlna_devices():
     """Discover DLNA clients on the network."""
-    if not upnpclient:
+    if not load_upnpclient():
         print("upnpclient not installed. DLNA discovery skipped.", flush=True)
         return
 
@@ -124,8 +1629,775 @@ def discover_dlna_devices():
     except Exception as e:
         print(f"DLNA discovery failed: {e}", flush=True)
 
-def start_discovery_thread():
-    threading.Thread(target=discover_dlna_devices, daemon=True).start()
+def discover_at_startup():
+    started = time.perf_counter()
+    try:
+        discover_dlna_devices()
+    finally:
+        record_startup('dlna_discovery', started)
+        DISCOVERY_DONE.set()
+
+def start_discovery():
+    """Start this process's first discovery scan, once, in the background."""
+    global DISCOVERY_PID
+    if DISCOVERY_PID == os.getpid():
+        return
+    with BACKGROUND_LOCK:
+        if DISCOVERY_PID == os.getpid():
+            return
+        DISCOVERY_PID = os.getpid()
+        threading.Thread(target=discover_at_startup, daemon=True).start()
+
+# ── Live handoff ──────────────────────────────────────────────────────────────
+# A HUP reload starts a new worker beside the old one and then sends the old one
+# SIGTERM. Each worker listens on cache/handoff-<pid>.sock, and the draining one
+# hands everything that's playing to a successor found there: per station, the
+# decoder and encoder processes with their pipes, each output's ring (and the
+# timeshift store's file) and, per listener relaying straight to its socket, the
+# client connection and its read position, descriptors passed with SCM_RIGHTS.
+# The ffmpegs never notice and the new worker relays on from the next byte, so
+# listeners hear no gap. Beforehand every thread reading those pipes or writing
+# those sockets stops between reads (see wait_readable and RingReader), so no
+# byte is lost or sent twice; the old worker's copies of the descriptors are
+# then closed, and a moved client's descriptor is pointed at a throwaway socket
+# so whatever gunicorn still writes or closes there doesn't reach the client.
+# A listener still on its first chunk (sent through WSGI) can't be moved and
+# ends with the drain, as does a station the successor already runs itself: its
+# listeners join that one's outputs at live. Messages are a 4-byte length and
+# JSON, any descriptors follow alongside one byte, and each is acknowledged with
+# b'+' or b'-' before the next is sent.
+HANDOFF_WAIT = 3  # How long a draining worker looks for a successor (seconds)
+HANDOFF_SOCKET_RE = re.compile(r'^handoff-(\d+)\.sock$')
+HANDOFF_LISTENER_PID = None
+HANDOFF_LOCK = threading.Lock()
+HANDOFF_STANDINS = []  # Sockets that moved clients' descriptors now point at
+
+def handoff_socket_path(pid):
+    return os.path.join(CACHE_DIR, f"handoff-{pid}.sock")
+
+def start_handoff_listener():
+    """Listen for a draining predecessor, once per process."""
+    global HANDOFF_LISTENER_PID
+    with HANDOFF_LOCK:
+        if HANDOFF_LISTENER_PID == os.getpid():
+            return
+        HANDOFF_LISTENER_PID = os.getpid()
+    path = handoff_socket_path(os.getpid())
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        remove_handoff_socket(path)  # Left by an earlier process with our pid
+        server.bind(path)
+        server.listen(2)
+    except OSError as e:
+        server.close()
+        print(f"Live handoff unavailable: {e}", flush=True)
+        return
+    threading.Thread(target=accept_handoffs, args=(server,), daemon=True).start()
+
+def remove_handoff_socket(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def accept_handoffs(server):
+    while True:
+        conn, _ = server.accept()
+        threading.Thread(target=receive_handoff, args=(conn,), daemon=True).start()
+
+def recv_exact(conn, n):
+    data = bytearray()
+    while len(data) < n:
+        chunk = conn.recv(n - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+def send_handoff(conn, msg, fds=()):
+    """Send one message and its descriptors; True if the successor took it."""
+    payload = json.dumps(dict(msg, fds=len(fds))).encode()
+    conn.sendall(len(payload).to_bytes(4, 'big') + payload)
+    if fds:
+        socket.send_fds(conn, [b'F'], list(fds))
+    return recv_exact(conn, 1) == b'+'
+
+def recv_handoff(conn):
+    """Next message and its descriptors, or (None, []) once the sender is done."""
+    header = recv_exact(conn, 4)
+    payload = header and recv_exact(conn, int.from_bytes(header, 'big'))
+    if not payload:
+        return None, []
+    msg = json.loads(payload)
+    fds = []
+    if msg['fds']:
+        _, fds, _, _ = socket.recv_fds(conn, 1, msg['fds'])
+    return msg, list(fds)
+
+def to_b64(data):
+    return None if data is None else base64.b64encode(data).decode()
+
+def from_b64(text):
+    return None if text is None else base64.b64decode(text)
+
+class AdoptedProcess:
+    """Stand-in for the Popen of an ffmpeg a predecessor worker started. It isn't
+    our child and can't be waited on, so its exit is read from /proc, where it
+    shows as a zombie, or is gone once reaped. The exit status stays unknown."""
+
+    def __init__(self, pid, stdin=None, stdout=None, stderr=None):
+        self.pid = pid
+        self.stdin = stdin
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            try:
+                with open(f"/proc/{self.pid}/stat") as f:
+                    state = f.read().rsplit(')', 1)[1].split()[0]
+            except (OSError, IndexError):
+                state = 'X'
+            if state in ('Z', 'X'):
+                self.returncode = -1
+        return self.returncode
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.poll() is None:
+            if deadline is not None and time.monotonic() > deadline:
+                raise subprocess.TimeoutExpired(f"ffmpeg (pid {self.pid})", timeout)
+            time.sleep(0.05)
+        return self.returncode
+
+    def send_signal(self, sig):
+        if self.poll() is None:
+            try:
+                os.kill(self.pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+# Predecessor side
+
+def find_successor(deadline):
+    """Connect to another worker that will take our streams, waiting until
+    `deadline` for one still starting up. None if there is none."""
+    while True:
+        try:
+            names = os.listdir(CACHE_DIR)
+        except OSError:
+            names = []
+        for name in names:
+            m = HANDOFF_SOCKET_RE.match(name)
+            if not m or int(m.group(1)) == os.getpid():
+                continue
+            path = os.path.join(CACHE_DIR, name)
+            conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            conn.settimeout(5)
+            try:
+                conn.connect(path)
+                if conn.recv(1) == b'R':
+                    return conn
+            except ConnectionRefusedError:
+                remove_handoff_socket(path)  # Left by a worker that has exited
+            except OSError:
+                pass
+            conn.close()
+        if time.monotonic() >= deadline:
+            return None
+        time.sleep(0.2)
+
+def park_graphs(deadline):
+    """Stop the threads of every running graph (graph thread, log and progress
+    readers, output pumps) and of its listeners relaying straight to their
+    sockets, each between two reads. Returns [(graph, encoders, listeners)] for
+    the graphs that stopped; one that ended meanwhile shuts itself down. A
+    listener whose relay hasn't stopped by the deadline isn't moved."""
+    with ENCODERS_LOCK:
+        graphs = [graph for graph in GRAPHS.values() if graph['feeding'] and not graph['closing']]
+        for graph in graphs:
+            graph['handoff'] = True
+    parked = []
+    for graph in graphs:
+        while not graph['parked'].wait(0.05):
+            if graph['closing'] or time.monotonic() > deadline:
+                break
+        else:
+            for thread in (graph['log_thread'], graph['progress_thread']):
+                thread.join(max(0, deadline - time.monotonic()))
+            with ENCODERS_LOCK:
+                encoders = [enc for enc in graph['encoders'] if not enc['closing'] and enc['pump'].ident]
+                listeners = [sub['sess'] for enc in encoders for sub in enc['subscribers'].values()
+                             if sub['sess']['direct'] and sub['sess']['reader']]
+                for sess in listeners:
+                    sess['handoff'] = {"parked": threading.Event(), "done": threading.Event(), "moved": False}
+            for enc in encoders:
+                enc['pump'].join(max(0, deadline - time.monotonic()))
+                for ring in (enc['ring'], enc['timeshift']):
+                    if ring:
+                        with ring['cond']:
+                            ring['cond'].notify_all()
+            for sess in listeners:
+                sess['handoff']['parked'].wait(max(0, deadline - time.monotonic()))
+            parked.append((graph, encoders, listeners))
+    return parked
+
+def park_for_handoff(sess):
+    """Called by a listener's relay once its reader stopped for a handoff: wait
+    for the drain to move the client. True if it did."""
+    handoff = sess.get('handoff')
+    if not handoff:
+        return False
+    handoff['parked'].set()
+    handoff['done'].wait(DRAIN_TIMEOUT)
+    if handoff['moved']:
+        print(f"[{sess['id']}] Handed to the new worker", flush=True)
+    return handoff['moved']
+
+def graph_state(graph, encoders):
+    """A parked graph as a message and its descriptors: the decoder's stdout,
+    stderr and progress pipe, then per output its encoder's stdin, stdout and
+    stderr and, if it records, its timeshift store's file."""
+    proc = graph['process']
+    now = time.monotonic()
+    fds = [proc.stdout.fileno(), proc.stderr.fileno(), graph['progress_fd']]
+    outputs = []
+    for enc in encoders:
+        encoder = enc['process']
+        fds += [encoder.stdin.fileno(), encoder.stdout.fileno(), encoder.stderr.fileno()]
+        ring, store, ogg, run = enc['ring'], enc['timeshift'], enc['ogg'], enc['run']
+        if store:
+            fds.append(store['file'].fileno())
+        outputs.append({
+            "codec": enc['codec'], "bitrate": enc['bitrate'], "pid": encoder.pid,
+            "pcm_fed": enc['pcm_fed'], "bytes_in": enc['bytes_in'], "age": now - enc['started'],
+            "ring": {"capacity": ring['capacity'], "head": ring['head'], "data": to_b64(ring['view'])},
+            "timeshift": store and {"capacity": store['capacity'], "head": store['head']},
+            "ogg": ogg and {"header": to_b64(ogg['header']), "serial": to_b64(ogg['serial']),
+                            "sequence": ogg['sequence'], "granule": ogg['granule']},
+            "run": {"buf": to_b64(run['buf']), "header": to_b64(run['header']),
+                    "pre_skip": run['pre_skip'], "shift": run['shift']}
+        })
+    msg = {
+        "type": "graph", "pid": os.getpid(), "video_id": graph['video_id'], "decoder": proc.pid,
+        "source": graph['source'], "restarts": graph['restarts'], "pcm_read": graph['pcm_read'],
+        "upstream_bytes": graph['upstream_bytes'], "age": now - graph['started'], "outputs": outputs
+    }
+    return msg, fds
+
+def listener_state(sess):
+    reader = sess['reader']
+    ring = reader.ring
+    return {
+        "type": "listener", "pid": os.getpid(), "id": sess['id'], "video_id": sess['video_id'],
+        "codec": sess['codec'], "bitrate": sess['bitrate'], "client_ip": sess['client_ip'],
+        "chunked": sess['chunked'], "stall_timeout": sess['stall_timeout'],
+        "bytes_in": sess['bytes_in'], "bytes_out": sess['bytes_out'],
+        "age": time.monotonic() - sess['started'],
+        "timeshift": isinstance(reader, TimeshiftReader), "position": reader.position,
+        "offset": (reader.position - ring['head']) / ring['bytes_per_sec'],
+        "aligned": reader.aligned, "header_sent": reader.header_sent
+    }
+
+def release_graph(graph, encoders):
+    """Let go of a graph the successor took: forget it, close our copies of its
+    descriptors and end the listeners that stayed with us."""
+    with ENCODERS_LOCK:
+        if GRAPHS.get(graph['video_id']) is graph:
+            del GRAPHS[graph['video_id']]
+        graph['closing'] = True
+        outputs = [enc for enc in graph['outputs'].values() if not enc['closing']]
+        for enc in outputs:
+            enc['closing'] = True
+            if ENCODERS.get(enc['key']) is enc:
+                del ENCODERS[enc['key']]
+        leftover = [enc for enc in graph['encoders'] if enc not in encoders]
+        graph['encoders'].clear()
+    for enc in outputs:
+        close_output(enc)
+    for enc in leftover:
+        close_encoder_input(enc)
+        stop_process(enc['process'])
+    proc, graph['process'] = graph['process'], None
+    for pipe in (proc.stdout, proc.stderr):
+        pipe.close()
+    os.close(graph['progress_fd'])
+    for enc in encoders:
+        encoder, enc['process'] = enc['process'], None
+        for pipe in (encoder.stdin, encoder.stdout, encoder.stderr):
+            pipe.close()
+    print(f"[{graph['id']}] Transcoder handed to the new worker", flush=True)
+
+def abandon_graph(graph, encoders):
+    """Shut down a parked graph the successor didn't take. Its pumps have
+    stopped, so they can't reap its encoders; that's done here."""
+    shut_down_graph(graph)
+    for enc in encoders:
+        stop_process(enc['process'])
+        enc['process'].stderr.close()
+
+def detach_client(sock):
+    """Point our descriptor for a moved client at a throwaway socket."""
+    standin, peer = socket.socketpair()
+    os.dup2(standin.fileno(), sock.fileno())
+    standin.close()
+    HANDOFF_STANDINS.append(peer)
+
+def hand_over(conn):
+    """Move our casts, graphs and listeners to the successor on `conn`. Graphs
+    it doesn't take are shut down here."""
+    moved = 0
+    parked = []
+    flagged = []
+    try:
+        send_handoff(conn, dict(handoff_state(), type="state"))
+        parked = park_graphs(DRAIN_DEADLINE - 1)
+        flagged = [sess for _, _, listeners in parked for sess in listeners]
+        while parked:
+            graph, encoders, listeners = parked[0]
+            msg, fds = graph_state(graph, encoders)
+            if not send_handoff(conn, msg, fds):
+                break
+            parked.pop(0)
+            release_graph(graph, encoders)
+            for sess in listeners:
+                if sess['handoff']['parked'].is_set() and send_handoff(conn, listener_state(sess), [sess['socket'].fileno()]):
+                    detach_client(sess['socket'])
+                    sess['handoff']['moved'] = True
+                    moved += 1
+                sess['handoff']['done'].set()
+            send_handoff(conn, {"type": "settle", "video_id": graph['video_id']})
+    except Exception as e:
+        print(f"Live handoff failed: {e}", flush=True)
+    finally:
+        for graph, encoders, _ in parked:
+            abandon_graph(graph, encoders)
+        for sess in flagged:
+            sess['handoff']['done'].set()
+    print(f"Handed {moved} listeners to the new worker", flush=True)
+
+# Successor side
+
+def receive_handoff(conn):
+    """Take over what a draining predecessor sends, one message at a time."""
+    with conn:
+        if DRAIN_DEADLINE:
+            return  # Draining ourselves; it has to look elsewhere
+        conn.sendall(b'R')
+        start_background()
+        adopted = {}  # Map video_id to the graph taken over, or None if refused
+        while True:
+            try:
+                msg, fds = recv_handoff(conn)
+            except (OSError, ValueError) as e:
+                print(f"Handoff interrupted: {e}", flush=True)
+                return
+            if msg is None:
+                return
+            try:
+                if msg['type'] == 'state':
+                    adopt_handoff_state(msg, recast=False)
+                elif msg['type'] == 'graph':
+                    adopted[msg['video_id']] = adopt_graph(msg, fds)
+                elif msg['type'] == 'listener':
+                    adopt_listener(msg, fds, adopted.get(msg['video_id']))
+                elif msg['type'] == 'settle':
+                    settle_graph(adopted.get(msg['video_id']))
+                reply = b'+'
+            except Exception as e:
+                print(f"Handoff of {msg['type']} {msg.get('video_id', '')} failed: {e}", flush=True)
+                reply = b'-'
+            for fd in fds:  # Whatever an adopter didn't take
+                os.close(fd)
+            conn.sendall(reply)
+
+def adopt_timeshift_store(key, f, state):
+    mm = mmap.mmap(f.fileno(), state['capacity'])
+    store = dict(
+        new_ring(memoryview(mm), state['capacity'], key[2] * 125),
+        key=key, path=timeshift_path(key), file=f, mm=mm, users=1, last_used=time.monotonic()
+    )
+    store['head'] = state['head']
+    with TIMESHIFT_LOCK:
+        idle = TIMESHIFT_STORES.get(key)
+        TIMESHIFT_STORES[key] = store
+    if idle:
+        close_timeshift_store(idle)  # Only ever an idle one: the station wasn't running here
+    return store
+
+def adopt_graph(msg, fds):
+    """Take over a predecessor's graph and start its threads on the pipes it
+    passed. Returns the graph, or None if we run that station ourselves, in
+    which case its processes are stopped and its listeners join ours."""
+    video_id = msg['video_id']
+    files = [os.fdopen(fd, 'rb', buffering=0) for fd in fds[:2]]
+    progress_fd = fds[2]
+    pos = 3
+    outputs = []
+    for out in msg['outputs']:
+        pipes = [os.fdopen(fds[pos], 'wb', buffering=0)] + [os.fdopen(fd, 'rb', buffering=0) for fd in fds[pos + 1:pos + 3]]
+        pos += 3
+        store_file = None
+        if out['timeshift']:
+            store_file = os.fdopen(fds[pos], 'r+b')
+            pos += 1
+        outputs.append((out, pipes, store_file))
+    fds.clear()  # All ours now
+
+    now = time.monotonic()
+    graph = new_graph(video_id)
+    graph.update(
+        source=msg['source'], restarts=msg['restarts'], pcm_read=msg['pcm_read'],
+        upstream_bytes=msg['upstream_bytes'],
+        started=now - msg['age'], spawned=now, progress_fd=progress_fd,
+        process=AdoptedProcess(msg['decoder'], stdout=files[0], stderr=files[1])
+    )
+    with ENCODERS_LOCK:
+        running = GRAPHS.get(video_id)
+        if running is None or running['closing']:
+            GRAPHS[video_id] = graph
+        else:
+            graph = None
+    if graph is None:
+        print(f"[{video_id}] Already running here, stopping the handed-over transcoder", flush=True)
+        for pid in [msg['decoder']] + [out['pid'] for out, _, _ in outputs]:
+            AdoptedProcess(pid).terminate()
+        for f in files + [f for _, pipes, store_file in outputs for f in pipes + [store_file] if f]:
+            f.close()
+        os.close(progress_fd)
+        return None
+
+    if msg['source']:
+        with MANIFEST_LOCK:
+            SOURCE_CHOICES[video_id] = msg['source']
+    for out, pipes, store_file in outputs:
+        key = (video_id, out['codec'], out['bitrate'])
+        store = store_file and adopt_timeshift_store(key, store_file, out['timeshift'])
+        ring = out['ring']
+        with ENCODERS_LOCK:
+            enc = new_output(graph, out['codec'], out['bitrate'], store)
+            enc['ring'] = new_ring(memoryview(bytearray(from_b64(ring['data']))), ring['capacity'], out['bitrate'] * 125)
+            enc['ring']['head'] = ring['head']
+            if enc['ogg'] is not None:
+                ogg = out['ogg']
+                enc['ogg'].update(header=from_b64(ogg['header']), serial=from_b64(ogg['serial']),
+                                  sequence=ogg['sequence'], granule=ogg['granule'])
+            run = out['run']
+            header = from_b64(run['header'])
+            enc['run'].update(buf=bytearray(from_b64(run['buf'])), header=None if header is None else bytearray(header),
+                              pre_skip=run['pre_skip'], shift=run['shift'])
+            enc.update(
+                pcm_fed=out['pcm_fed'], bytes_in=out['bytes_in'], sample_bytes=out['bytes_in'],
+                started=now - out['age'], process=AdoptedProcess(out['pid'], *pipes)
+            )
+            enc['pump'] = threading.Thread(target=pump_output, args=(graph, enc, enc['process']), daemon=True)
+            graph['encoders'].append(enc)
+    start_graph_readers(graph, graph['process'])
+    for enc in list(graph['encoders']):
+        enc['pump'].start()
+    threading.Thread(target=run_graph, args=(graph,), daemon=True).start()
+    print(f"[{graph['id']}] Transcoder taken over: {', '.join(enc['id'] for enc in graph['outputs'].values())}", flush=True)
+    return graph
+
+def adopt_listener(msg, fds, graph):
+    """Take over a listener's connection and relay to it from where the
+    predecessor stopped; on an output not handed over, from live (or its
+    timeshift offset)."""
+    sock = socket.socket(fileno=fds.pop())
+    sock.settimeout(None)
+    sess = new_listener(
+        msg['id'], msg['video_id'], msg['codec'], msg['bitrate'], msg['client_ip'],
+        sock, msg['chunked'], msg['stall_timeout']
+    )
+    sess.update(bytes_in=msg['bytes_in'], bytes_out=msg['bytes_out'], started=time.monotonic() - msg['age'])
+    session_key = listener_in(sess)
+    enc = reader = None
+    try:
+        enc, reader = subscribe_encoder(msg['video_id'], msg['codec'], msg['bitrate'], session_key, sess, timeshift=msg['timeshift'])
+        if graph is None or enc['graph'] is not graph:
+            reader = reader or TimeshiftReader(enc, msg['offset'], sess)
+        else:
+            if reader is None:
+                reader = TimeshiftReader(enc, 0, sess, msg['position'])
+            else:
+                reader.position = msg['position']
+            reader.aligned, reader.header_sent = msg['aligned'], msg['header_sent']
+        sess['reader'] = reader
+        sess['direct'] = True
+        threading.Thread(target=serve_adopted_listener, args=(session_key, sess, enc, reader), daemon=True).start()
+    except Exception:
+        listener_out(session_key, sess)
+        if enc:
+            unsubscribe_encoder(enc, session_key)
+        if reader:
+            reader.close()
+        sock.close()
+        raise
+
+def serve_adopted_listener(session_key, sess, enc, reader):
+    """Relay to a taken-over listener's socket as the predecessor was doing, and
+    end the response the way gunicorn would have."""
+    sock = sess['socket']
+    try:
+        send_to_socket(reader, memoryview(bytearray(RELAY_CHUNK_MAX)), sock, sess, sess['chunked'])
+        if not park_for_handoff(sess) and sess['chunked']:
+            sock.sendall(b'0\r\n\r\n')
+    except (BrokenPipeError, ConnectionResetError):
+        print(f"[{sess['id']}] Client disconnected.", flush=True)
+    except Exception as e:
+        print(f"[{sess['id']}] Error: {e}", flush=True)
+    finally:
+        listener_out(session_key, sess)
+        unsubscribe_encoder(enc, session_key)
+        reader.close()
+        sock.close()
+
+def settle_graph(graph):
+    """Once a graph's listeners are all across, drop the outputs none of them
+    came back to, as the last listener leaving would have."""
+    if graph is None:
+        return
+    with ENCODERS_LOCK:
+        idle = [enc for enc in graph['outputs'].values() if not enc['subscribers'] and not enc['closing']]
+        procs = [detach_output(enc) for enc in idle]
+    for enc in idle:
+        close_output(enc)
+    for proc in procs:
+        if proc and proc.poll() is None:
+            proc.terminate()
+
+# ── Renderer sessions ─────────────────────────────────────────────────────────
+# One record per renderer we've cast to, keyed by UDN: what it plays, where its
+# description lives and its last known transport state. upnpclient Devices (a
+# fetched and parsed description plus service tree) are cached per location, so
+# stopping, re-casting and polling never rediscover. Each renderer's SOAP sequence
+# runs on its own thread and callers wait at most CAST_TIMEOUT seconds for the
+# lot. A group member that only starts playing after that has already been
+# reported as failed, so it is sent Stop rather than left playing where the
+# dashboard can't reach it. That wait only bounds the response, so each HTTP
+# request to a renderer also times out after RENDERER_TIMEOUT seconds without an
+# answer: a hung renderer ends its call with an error, freeing the thread.
+# GetTransportInfo is only polled when /api/dlna/sessions is read, at most every
+# CAST_STATE_TTL seconds.
+# Every playing renderer holds a server thread for as long as it streams, so the
+# group size is capped well below the image's gunicorn --threads (32).
+CAST_TIMEOUT = float(os.getenv('CAST_TIMEOUT', '8'))
+RENDERER_TIMEOUT = float(os.getenv('RENDERER_TIMEOUT', '5'))
+CAST_STATE_TTL = float(os.getenv('CAST_STATE_TTL', '10'))
+CAST_GROUP_MAX = 16
+CAST_ENDED_STATES = ('STOPPED', 'NO_MEDIA_PRESENT', 'ERROR')
+CAST_SESSIONS = {}  # Map renderer UDN to its cast session
+CASTS_LOCK = threading.Lock()
+RENDERER_DEVICES = {}  # Map description URL to upnpclient.Device
+RENDERERS_LOCK = threading.Lock()
+
+def get_renderer(location):
+    """Cached upnpclient.Device for a description URL."""
+    with RENDERERS_LOCK:
+        device = RENDERER_DEVICES.get(location)
+    if device is None:
+        device = upnpclient.Device(location)
+        with RENDERERS_LOCK:
+            RENDERER_DEVICES[location] = device
+    return device
+
+def renderer_location(udn):
+    """Description URL for a UDN from past casts or the discovery cache, or None."""
+    with CASTS_LOCK:
+        if udn in CAST_SESSIONS:
+            return CAST_SESSIONS[udn]['location']
+    with DEVICES_LOCK:
+        return next((d['location'] for d in DLNA_DEVICES if d['udn'] == udn), None)
+
+def locate_renderers(udns, names):
+    """Description URL (or None) for each UDN, with one discovery pass for every
+    renderer we have never seen. Names found by that pass are added to `names`."""
+    locations = {udn: renderer_location(udn) for udn in udns}
+    missing = [udn for udn, location in locations.items() if not location]
+    if missing:
+        try:
+            for device in upnpclient.discover():
+                if device.udn in missing:
+                    locations[device.udn] = device.location
+                    names.setdefault(device.udn, device.friendly_name)
+                    with RENDERERS_LOCK:
+                        RENDERER_DEVICES[device.location] = device
+        except Exception as e:
+            print(f"Renderer discovery failed: {e}", flush=True)
+    return locations
+
+def av_transport_of(device):
+    return next((s for s in device.services if "AVTransport" in s.service_id), None)
+
+def run_concurrently(calls, timeout, on_late=None):
+    """Run each (fn, args) on its own thread and wait for all of them, up to
+    `timeout` seconds in total. Returns each result, or None if still running;
+    such a call, once it returns, gets on_late(result, *args) on its thread."""
+    results = [None] * len(calls)
+    lock = threading.Lock()
+    expired = []
+
+    def run(i, fn, args):
+        result = fn(*args)
+        with lock:
+            late = bool(expired)
+            results[i] = result
+        if late and on_late:
+            on_late(result, *args)
+
+    threads = [threading.Thread(target=run, args=(i, fn, args), daemon=True) for i, (fn, args) in enumerate(calls)]
+    for t in threads:
+        t.start()
+    deadline = time.monotonic() + timeout
+    for t in threads:
+        t.join(max(0, deadline - time.monotonic()))
+    with lock:
+        expired.append(True)
+        return list(results)
+
+def set_cast_state(cast, state, message=''):
+    cast['state'] = state
+    cast['message'] = message
+    cast['updated'] = time.time()
+
+def cast_result(cast, result):
+    return {
+        "udn": cast['udn'],
+        "device_name": cast['device_name'],
+        "success": result is True,
+        "state": cast['state'],
+        "message": cast['message'] or ("timed out" if result is None else "")
+    }
+
+def cast_stream_url(cast):
+    ext = CODECS[cast['codec']]['ext']
+    return f"http://{get_server_ip()}:5000/stream.{ext}?v={cast['video_id']}&br={cast['bitrate']}"
+
+def perform_cast(device, cast):
+    """Point a renderer at our stream and press Play, tracking it in the session
+    table (which also carries it across a restart). Returns True on success."""
+    vid, name, bitrate = cast['video_id'], cast['station'], cast['bitrate']
+    url = cast_stream_url(cast)
+    mimetype = CODECS[cast['codec']]['mimetype']
+    set_cast_state(cast, 'STARTING')
+    cast['polled'], cast['polling'] = 0, False
+    with CASTS_LOCK:
+        CAST_SESSIONS[cast['udn']] = cast
+    try:
+        print(f"[{vid}] Background cast starting for {device.friendly_name}...", flush=True)
+        av_transport = av_transport_of(device)
+        if not av_transport:
+            print(f"[{vid}] Error: AVTransport not found on {device.friendly_name}", flush=True)
+            set_cast_state(cast, 'ERROR', "AVTransport not found")
+            return False
+        
+        # Generate DIDL-Lite Metadata (res@bitrate is bytes/second per UPnP)
+        escaped_name = html.escape(name)
+        metadata = f"""<DIDL-Lite xmlns="urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/" xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:upnp="urn:schemas-upnp-org:metadata-1-0/upnp/">
+            <item id="1" parentID="0" restricted="1">
+                <dc:title>{escaped_name}</dc:title>
+                <upnp:class>object.item.audioItem.musicTrack</upnp:class>
+                <dc:creator>Live2Audio</dc:creator>
+                <upnp:artist>Live2Audio</upnp:artist>
+                <res protocolInfo="http-get:*:{mimetype}:*" bitrate="{bitrate * 125}">{html.escape(url)}</res>
+            </item>
+        </DIDL-Lite>"""
+
+        # 1. Stop if needed
+        try:
+            print(f"[{vid}] Sending Stop to {device.friendly_name}...", flush=True)
+            av_transport.Stop(InstanceID=0)
+        except Exception as e:
+            print(f"[{vid}] Stop (optional) failed: {e}", flush=True)
+        
+        # 2. Set URI with Metadata
+        print(f"[{vid}] Setting URI to {url} with metadata...", flush=True)
+        av_transport.SetAVTransportURI(
+            InstanceID=0,
+            CurrentURI=url,
+            CurrentURIMetaData=metadata
+        )
+        
+        # 3. Play
+        print(f"[{vid}] Sending Play command...", flush=True)
+        av_transport.Play(InstanceID=0, Speed='1')
+        print(f"[{vid}] Cast successful on {device.friendly_name}", flush=True)
+        # Renderers report TRANSITIONING while they buffer; the next poll settles it
+        set_cast_state(cast, 'TRANSITIONING')
+        return True
+    except Exception as e:
+        print(f"[{vid}] Background cast failed: {e}", flush=True)
+        set_cast_state(cast, 'ERROR', str(e)[:100])
+        with LOG_LOCK:
+            ERROR_LOG.append(f"{datetime.now().strftime('%H:%M:%S')} - Cast Error: {str(e)[:50]}")
+        return False
+
+def start_cast(cast):
+    """Cast to a renderer known only by its session record (group casts, and
+    renderers handed over by the previous process)."""
+    if not load_upnpclient() or not is_safe_dlna_location(cast['location']):
+        set_cast_state(cast, 'ERROR', "Renderer is not on the LAN")
+        return False
+    try:
+        device = get_renderer(cast['location'])
+    except Exception as e:
+        print(f"[{cast['video_id']}] Could not reach {cast['device_name']}: {e}", flush=True)
+        set_cast_state(cast, 'ERROR', f"Unreachable: {str(e)[:80]}")
+        return False
+    return perform_cast(device, cast)
+
+def abandon_cast(result, cast):
+    """Undo a group cast that finished after the response called it timed out."""
+    if result is not True:
+        return
+    print(f"[{cast['video_id']}] {cast['device_name']} answered after the group deadline, stopping it", flush=True)
+    if stop_cast(cast):
+        set_cast_state(cast, 'STOPPED', "Timed out")
+
+def stop_cast(cast):
+    try:
+        av_transport = av_transport_of(get_renderer(cast['location']))
+        if not av_transport:
+            set_cast_state(cast, 'ERROR', "AVTransport not found")
+            return False
+        av_transport.Stop(InstanceID=0)
+        set_cast_state(cast, 'STOPPED')
+        return True
+    except Exception as e:
+        set_cast_state(cast, 'ERROR', str(e)[:100])
+        return False
+
+def poll_cast_state(cast):
+    try:
+        info = av_transport_of(get_renderer(cast['location'])).GetTransportInfo(InstanceID=0)
+        cast['state'] = info.get('CurrentTransportState', cast['state'])
+        cast['message'] = ''
+    except Exception as e:
+        cast['state'] = 'UNREACHABLE'
+        cast['message'] = str(e)[:100]
+    finally:
+        cast['polled'] = time.monotonic()
+        cast['polling'] = False
+
+def refresh_cast_states():
+    """Start a background poll for every live session whose state is stale.
+    Ended sessions aren't polled: the renderer may be playing someone else's
+    content by now, and that mustn't make it look like our cast."""
+    now = time.monotonic()
+    with CASTS_LOCK:
+        stale = [c for c in CAST_SESSIONS.values() if c['state'] not in CAST_ENDED_STATES
+                 and not c.get('polling') and now - c.get('polled', 0) > CAST_STATE_TTL]
+        for cast in stale:
+            cast['polling'] = True
+    for cast in stale:
+        threading.Thread(target=poll_cast_state, args=(cast,), daemon=True).start()
 
 PENDING_DOWNLOADS = set()
 DOWNLOADS_LOCK = threading.Lock()
@@ -136,13 +2408,10 @@ AVAILABILITY_LOCK = threading.Lock()
 def check_stream_availability(video_id):
     if not valid_video_id(video_id):
         return
-    youtube_url = build_youtube_url(video_id)
     try:
-        result = subprocess.run(
-            ['yt-dlp', '-g', '-f', 'ba/b', '--no-playlist', youtube_url],
-            capture_output=True, text=True, timeout=30
-        )
-        status = "available" if result.returncode == 0 else "unavailable"
+        # Fetching the format list doubles as the availability probe and primes
+        # the cache the encoders pick their source from
+        status = "available" if get_format_manifest(video_id, refresh=True) else "unavailable"
     except subprocess.TimeoutExpired:
         status = "unavailable"
     except Exception:
@@ -290,6 +2559,66 @@ def get_available_streams():
             return LAST_GOOD_STREAMS
     return streams
 
+def build_station_index(streams, stamp):
+    entries = list(streams)
+    return {
+        "stamp": stamp,
+        # Lets clients tell "same list, fresh counters" from "list changed"
+        "version": format(hash(tuple((s['id'], s['name'], s['tvg_id'], s['group'], s['url']) for s in entries)) & 0xffffffff, 'x'),
+        "streams": entries,
+        "search": [f"{s['name']}\n{s['group']}\n{s['tvg_id']}".lower() for s in entries],
+        "groups": [s['group'].lower() for s in entries],
+        "headers": [station_header(s).lower() for s in entries]
+    }
+
+def station_header(stream):
+    """The dashboard's grouping of a station: its tvg_id, not its group-title."""
+    return stream['tvg_id'] or 'Other'
+
+def get_station_index():
+    """Return the station index, reparsing youtube.m3u only if its mtime/size moved."""
+    global STATION_INDEX
+    try:
+        st = os.stat("youtube.m3u")
+        stamp = (st.st_mtime_ns, st.st_size)
+    except OSError:
+        stamp = None
+    with INDEX_LOCK:
+        if STATION_INDEX and stamp and STATION_INDEX['stamp'] == stamp:
+            return STATION_INDEX
+    index = build_station_index(get_available_streams(), stamp)
+    with INDEX_LOCK:
+        STATION_INDEX = index
+    return index
+
+def query_station_index(index, group='', q='', tvg_id=''):
+    """Filter the index by exact group-title, by exact header (tvg_id, or "Other"
+    for none) and by every whitespace-separated term of `q` appearing in a
+    station's name, group or tvg_id."""
+    group = group.strip().lower()
+    tvg_id = tvg_id.strip().lower()
+    terms = q.lower().split()
+    return [
+        stream for stream, text, stream_group, header
+        in zip(index['streams'], index['search'], index['groups'], index['headers'])
+        if (not group or stream_group == group) and (not tvg_id or header == tvg_id)
+        and all(t in text for t in terms)
+    ]
+
+def station_snapshot(stream):
+    """Copy of a parsed station with live listener/availability counters."""
+    with STREAMS_LOCK:
+        listeners = ACTIVE_STREAMS.get(stream['id'], 0)
+    with AVAILABILITY_LOCK:
+        availability = STREAM_AVAILABILITY.get(stream['id'], "checking")
+    return dict(stream, listeners=listeners, availability=availability)
+
+@app.before_request
+def ensure_background():
+    start_background()
+    if request.path.startswith('/api/dlna/'):
+        start_discovery()
+
 @app.before_request
 def log_request():
     print(f"Incoming: {request.method} {request.path}", flush=True)
@@ -521,18 +2850,23 @@ def delete_station():
 
 @app.route('/api/dlna/devices')
 def get_dlna_devices():
+    # The cast dialog's first look shouldn't come back empty mid-scan
+    DISCOVERY_DONE.wait(DISCOVERY_WAIT)
     with DEVICES_LOCK:
         return jsonify(DLNA_DEVICES)
 
 @app.route('/api/dlna/refresh', methods=['POST'])
 def refresh_dlna_devices():
-    discover_dlna_devices()
+    if DISCOVERY_DONE.is_set():
+        discover_dlna_devices()
+    else:
+        DISCOVERY_DONE.wait(DISCOVERY_WAIT)  # The first scan is still fresh
     with DEVICES_LOCK:
         return jsonify(DLNA_DEVICES)
 
 @app.route('/api/dlna/cast', methods=['POST'])
 def cast_to_dlna():
-    if not upnpclient:
+    if not load_upnpclient():
         return jsonify({"success": False, "message": "upnpclient not installed"}), 500
 
     data = request.json
@@ -546,58 +2880,20 @@ def cast_to_dlna():
     if not valid_video_id(video_id):
         return jsonify({"success": False, "message": "Invalid video ID"}), 400
 
+    requested_bitrate = None
+    if data.get('bitrate'):
+        requested_bitrate = parse_bitrate(data.get('bitrate'))
+        if not requested_bitrate:
+            return jsonify({"success": False, "message": f"Unsupported bitrate; allowed: {BITRATE_TIERS}"}), 400
+
+    codec = data.get('codec') or 'mp3'
+    if codec not in CODECS:
+        return jsonify({"success": False, "message": f"Unsupported codec; allowed: {list(CODECS)}"}), 400
+
     # Block SSRF: a user-supplied manual target must resolve to a private address
     if manual_location and not is_safe_dlna_location(manual_location):
         return jsonify({"success": False, "message": "Target must be a private/LAN address"}), 400
 
-    # Construct the absolute stream URL
-    server_ip = get_server_ip()
-    stream_url = f"http://{server_ip}:5000/stream.mp3?v={video_id}"
-    
-    def perform_cast(device, url, vid, name):
-        try:
-            print(f"[{vid}] Background cast starting for {device.friendly_name}...", flush=True)
-            av_transport = next((s for s in device.services if "AVTransport" in s.service_id), None)
-            if not av_transport:
-                print(f"[{vid}] Error: AVTransport not found on {device.friendly_name}", flush=True)
-                return
-            
-            # Generate DIDL-Lite Metadata
-            escaped_name = html.escape(name)
-            metadata = f"""<DIDL-Lite xmlns="urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/" xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:upnp="urn:schemas-upnp-org:metadata-1-0/upnp/">
-                <item id="1" parentID="0" restricted="1">
-                    <dc:title>{escaped_name}</dc:title>
-                    <upnp:class>object.item.audioItem.musicTrack</upnp:class>
-                    <dc:creator>Live2Audio</dc:creator>
-                    <upnp:artist>Live2Audio</upnp:artist>
-                    <res protocolInfo="http-get:*:audio/mpeg:*">{url}</res>
-                </item>
-            </DIDL-Lite>"""
-
-            # 1. Stop if needed
-            try:
-                print(f"[{vid}] Sending Stop to {device.friendly_name}...", flush=True)
-                av_transport.Stop(InstanceID=0)
-            except Exception as e:
-                print(f"[{vid}] Stop (optional) failed: {e}", flush=True)
-            
-            # 2. Set URI with Metadata
-            print(f"[{vid}] Setting URI to {url} with metadata...", flush=True)
-            av_transport.SetAVTransportURI(
-                InstanceID=0,
-                CurrentURI=url,
-                CurrentURIMetaData=metadata
-            )
-            
-            # 3. Play
-            print(f"[{vid}] Sending Play command...", flush=True)
-            av_transport.Play(InstanceID=0, Speed='1')
-            print(f"[{vid}] Cast successful on {device.friendly_name}", flush=True)
-        except Exception as e:
-            print(f"[{vid}] Background cast failed: {e}", flush=True)
-            with LOG_LOCK:
-                ERROR_LOG.append(f"{datetime.now().strftime('%H:%M:%S')} - Cast Error: {str(e)[:50]}")
-
     try:
         target_device = None
         
@@ -615,7 +2911,7 @@ def cast_to_dlna():
             
             if location and is_safe_dlna_location(location):
                 try:
-                    target_device = upnpclient.Device(location)
+                    target_device = get_renderer(location)
                 except Exception as e:
                     print(f"Failed to connect to cached location {location}: {e}", flush=True)
             
@@ -663,50 +2959,248 @@ def cast_to_dlna():
             device_name = 'DLNA Device'
 
         station_name = VIDEO_ID_MAP.get(video_id, "Unknown Station")
+        device_udn = getattr(target_device, 'udn', manual_location)
+        bitrate = requested_bitrate or dlna_default_bitrate(device_udn, device_name)
+        cast = {
+            "location": getattr(target_device, 'location', None) or manual_location,
+            "udn": device_udn,
+            "device_name": device_name,
+            "video_id": video_id,
+            "station": station_name,
+            "codec": codec,
+            "bitrate": bitrate
+        }
+
+        with RENDERERS_LOCK:
+            RENDERER_DEVICES.setdefault(cast['location'], target_device)
 
         # Start the actual UPnP command sequence in a background thread
-        threading.Thread(target=perform_cast, args=(target_device, stream_url, video_id, station_name), daemon=True).start()
+        threading.Thread(target=perform_cast, args=(target_device, cast), daemon=True).start()
         
         return jsonify({
             "success": True, 
             "message": f"Cast initiated to {device_name}", 
             "device_name": device_name,
-            "udn": getattr(target_device, 'udn', manual_location)
+            "udn": device_udn,
+            "codec": codec,
+            "bitrate": bitrate
         })
     except Exception as e:
         print(f"Casting failed: {e}", flush=True)
         return jsonify({"success": False, "message": str(e)}), 500
 
+@app.route('/api/dlna/cast_group', methods=['POST'])
+def cast_group_to_dlna():
+    """Cast one station to several renderers at once. All of them get the same
+    URL, so they share one transcoder output; the SOAP sequences run in parallel
+    and the response reports each renderer, waiting at most CAST_TIMEOUT."""
+    if not load_upnpclient():
+        return jsonify({"success": False, "message": "upnpclient not installed"}), 500
+
+    data = request.json
+    udns = data.get('udns')
+    video_id = data.get('video_id')
+    if not isinstance(udns, list) or not udns or not video_id:
+        return jsonify({"success": False, "message": "Missing device UDNs or video ID"}), 400
+    udns = list(dict.fromkeys(udns))
+    if len(udns) > CAST_GROUP_MAX:
+        return jsonify({"success": False, "message": f"At most {CAST_GROUP_MAX} renderers per group"}), 400
+    if not valid_video_id(video_id):
+        return jsonify({"success": False, "message": "Invalid video ID"}), 400
+    requested_bitrate = None
+    if data.get('bitrate'):
+        requested_bitrate = parse_bitrate(data.get('bitrate'))
+        if not requested_bitrate:
+            return jsonify({"success": False, "message": f"Unsupported bitrate; allowed: {BITRATE_TIERS}"}), 400
+    codec = data.get('codec') or 'mp3'
+    if codec not in CODECS:
+        return jsonify({"success": False, "message": f"Unsupported codec; allowed: {list(CODECS)}"}), 400
+
+    with DEVICES_LOCK:
+        names = {d['udn']: d.get('name', 'DLNA Device') for d in DLNA_DEVICES}
+    locations = locate_renderers(udns, names)
+
+    # A shared URL needs one bitrate; default to what the weakest renderer wants
+    bitrate = requested_bitrate or min(dlna_default_bitrate(udn, names.get(udn)) for udn in udns)
+    station_name = VIDEO_ID_MAP.get(video_id, "Unknown Station")
+    casts, results = [], []
+    for udn in udns:
+        cast = {
+            "location": locations.get(udn), "udn": udn,
+            "device_name": names.get(udn, 'DLNA Device'),
+            "video_id": video_id, "station": station_name,
+            "codec": codec, "bitrate": bitrate
+        }
+        casts.append(cast)
+    print(f"[{video_id}] Group cast to {len(casts)} renderers at {codec}/{bitrate}k", flush=True)
+    calls = [(start_cast, (cast,)) for cast in casts if cast['location']]
+    done = iter(run_concurrently(calls, CAST_TIMEOUT, on_late=abandon_cast))
+    for cast in casts:
+        if cast['location']:
+            results.append(cast_result(cast, next(done)))
+        else:
+            set_cast_state(cast, 'ERROR', "Device not found")
+            results.append(cast_result(cast, False))
+    return jsonify({
+        "success": any(r['success'] for r in results),
+        "video_id": video_id,
+        "codec": codec,
+        "bitrate": bitrate,
+        "results": results
+    })
+
+@app.route('/api/dlna/sessions')
+def get_dlna_sessions():
+    """Renderer session table, polling stale transport states in the background."""
+    refresh_cast_states()
+    with CASTS_LOCK:
+        sessions = [{key: cast[key] for key in (
+            'udn', 'device_name', 'location', 'video_id', 'station', 'codec', 'bitrate', 'state', 'message', 'updated'
+        )} for cast in CAST_SESSIONS.values()]
+    return jsonify(sessions)
+
+@app.route('/api/stations')
+def api_stations():
+    try:
+        offset = max(0, int(request.args.get('offset', 0)))
+        limit = min(STATION_PAGE_MAX, max(1, int(request.args.get('limit', 50))))
+    except ValueError:
+        return jsonify({"status": "error", "message": "offset and limit must be integers"}), 400
+
+    index = get_station_index()
+    matches = query_station_index(index, request.args.get('group', ''), request.args.get('q', ''),
+                                  request.args.get('tvg_id', ''))
+
+    # Start index of each run of equal tvg_id (the dashboard's grouping) so a
+    # client can place every header without loading every page. A header's name
+    # is what tvg_id= filters on; group= filters on group-title instead.
+    groups = []
+    for i, stream in enumerate(matches):
+        key = station_header(stream)
+        if not groups or groups[-1]['name'] != key:
+            groups.append({"start": i, "name": key})
+
+    return jsonify({
+        "version": index['version'],
+        "total": len(matches),
+        "offset": offset,
+        "limit": limit,
+        "groups": groups,
+        "stations": [station_snapshot(s) for s in matches[offset:offset + limit]]
+    })
+
 @app.route('/api/stats')
 def api_stats():
     uptime = str(datetime.now() - START_TIME).split('.')[0]
-    streams = get_available_streams()
+    index = get_station_index()
     with STREAMS_LOCK:
         live_count = sum(1 for count in ACTIVE_STREAMS.values() if count > 0)
+    with ENCODERS_LOCK:
+        encoders = [{
+            "video_id": enc['video_id'],
+            "codec": enc['codec'],
+            "bitrate": enc['bitrate'],
+            "listeners": len(enc['subscribers']),
+            "rate": enc['rate'],
+            "timeshift_seconds": timeshift_seconds(enc['timeshift']) if enc['timeshift'] else 0
+        } for enc in ENCODERS.values()]
+        graphs = {graph['video_id']: {
+            "outputs": [f"{enc['codec']}:{enc['bitrate']}k" for enc in graph['outputs'].values()],
+            "restarts": graph['restarts'],
+            "progress": graph['progress']
+        } for graph in GRAPHS.values()}
+    with MANIFEST_LOCK:
+        sources = {vid: dict(choice) for vid, choice in SOURCE_CHOICES.items()}
     return jsonify({
         "server_id": SERVER_ID,
         "uptime": uptime,
         "live_count": live_count,
         "recently_played": LAST_STREAM["name"],
-        "streams": streams,
-        "errors": list(ERROR_LOG)
+        "station_count": len(index['streams']),
+        "station_version": index['version'],
+        "bitrate_tiers": BITRATE_TIERS,
+        "codecs": list(CODECS),
+        "encoders": encoders,
+        "graphs": graphs,
+        "behind": [vid for vid, g in graphs.items() if g['progress'] and g['progress']['behind']],
+        "sources": sources,
+        "errors": list(ERROR_LOG),
+        "reaped_total": REAPED_TOTAL,
+        "reaped": list(REAPED_SESSIONS),
+        "startup_ms": STARTUP_TIMINGS
     })
 
+@app.route('/api/debug/profile')
+def profile():
+    if not PROFILER_ENABLED:
+        return page_not_found(None)
+    if not _host_is_private(request.remote_addr or ''):
+        return "Profiler is only available from private addresses", 403
+    try:
+        seconds = min(float(request.args.get('seconds', 5)), PROFILE_MAX_SECONDS)
+    except ValueError:
+        return "Invalid seconds", 400
+    if not seconds > 0:
+        return "Invalid seconds", 400
+    if not PROFILE_LOCK.acquire(blocking=False):
+        return "A profile is already running", 409
+    try:
+        samples, counts = sample_stacks(seconds, PROFILE_INTERVAL)
+    finally:
+        PROFILE_LOCK.release()
+    lines = [f"{stack} {n}" for stack, n in sorted(counts.items(), key=lambda item: -item[1])]
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain', headers={'X-Profile-Samples': str(samples)})
+
 @app.route('/api/dlna/stop', methods=['POST'])
 def stop_dlna():
-    if not upnpclient:
+    if not load_upnpclient():
         return jsonify({"success": False, "message": "upnpclient not installed"}), 500
 
     data = request.json
     udn = data.get('udn')
+    udns = data.get('udns') or []
     manual_location = data.get('manual_location', '').strip()
     
-    if not (udn or manual_location):
+    if not (udn or udns or manual_location):
         return jsonify({"success": False, "message": "Missing device UDN/IP"}), 400
 
     if manual_location and not is_safe_dlna_location(manual_location):
         return jsonify({"success": False, "message": "Target must be a private/LAN address"}), 400
 
+    # Renderers we cast to are stopped straight from the session table; any
+    # others (cast by another worker, or before a restart) are looked up first
+    if udns:
+        if not isinstance(udns, list) or len(udns) > CAST_GROUP_MAX:
+            return jsonify({"success": False, "message": f"udns must be a list of at most {CAST_GROUP_MAX}"}), 400
+        udns = list(dict.fromkeys(udns))
+        with CASTS_LOCK:
+            known = {u: CAST_SESSIONS[u] for u in udns if u in CAST_SESSIONS}
+        with DEVICES_LOCK:
+            names = {d['udn']: d.get('name', 'DLNA Device') for d in DLNA_DEVICES}
+        locations = locate_renderers([u for u in udns if u not in known], names)
+        casts = [known.get(u) or {"udn": u, "location": locations[u], "device_name": names.get(u, 'DLNA Device'),
+                                  "state": '', "message": ''} for u in udns]
+        results = run_concurrently([(stop_cast, (cast,)) for cast in casts if cast['location']], CAST_TIMEOUT)
+        done = iter(results)
+        report = []
+        for cast in casts:
+            if cast['location']:
+                report.append(cast_result(cast, next(done)))
+            else:
+                set_cast_state(cast, 'ERROR', "Device not found")
+                report.append(cast_result(cast, False))
+        return jsonify({
+            "success": all(r['success'] for r in report),
+            "results": report
+        })
+    with CASTS_LOCK:
+        cast = CAST_SESSIONS.get(udn) or next((c for c in CAST_SESSIONS.values() if manual_location and (
+            c['location'] == manual_location or urlparse(c['location']).hostname == manual_location)), None)
+    if cast:
+        if stop_cast(cast):
+            return jsonify({"success": True, "message": "Stopped DLNA playback"})
+        return jsonify({"success": False, "message": cast['message']}), 500
+
     try:
         target_device = None
         if udn:
@@ -727,7 +3221,7 @@ def stop_dlna():
         if not target_device:
             return jsonify({"success": False, "message": "Device not found"}), 404
             
-        av_transport = next((s for s in target_device.services if "AVTransport" in s.service_id), None)
+        av_transport = av_transport_of(target_device)
         if av_transport:
             av_transport.Stop(InstanceID=0)
             return jsonify({"success": True, "message": "Stopped DLNA playback"})
@@ -747,13 +3241,94 @@ def index():
         live_count=live_count
     )
 
+def new_listener(request_id, video_id, codec, bitrate, client_ip, sock, chunked, stall_timeout):
+    """A listener's session record, as the watchdog, /api/stats and a handoff
+    read it."""
+    now = time.monotonic()
+    return {
+        "id": request_id, "video_id": video_id, "codec": codec, "bitrate": bitrate,
+        "client_ip": client_ip, "socket": sock, "chunked": chunked, "reaped": None,
+        "subscription": None, "reader": None, "direct": False, "handoff": None,
+        "started": now, "last_write": now, "last_output": now,
+        "bytes_in": 0, "bytes_out": 0, "stall_timeout": stall_timeout
+    }
+
+def listener_in(sess):
+    """Count a listener in and register it with the watchdog. Returns its
+    session key."""
+    video_id, client_ip = sess['video_id'], sess['client_ip']
+    with STREAMS_LOCK:
+        ACTIVE_STREAMS[video_id] = ACTIVE_STREAMS.get(video_id, 0) + 1
+        current_listeners = ACTIVE_STREAMS[video_id]
+    with STREAM_IP_LOCK:
+        STREAM_IP_COUNTS[client_ip] = STREAM_IP_COUNTS.get(client_ip, 0) + 1
+    print(f"[{sess['id']}] Listener IN (Total: {current_listeners})", flush=True)
+    session_key = next(SESSION_SEQ)
+    with SESSIONS_LOCK:
+        STREAM_SESSIONS[session_key] = sess
+    return session_key
+
+def listener_out(session_key, sess):
+    global REAPED_TOTAL
+    video_id, client_ip = sess['video_id'], sess['client_ip']
+    with STREAMS_LOCK:
+        ACTIVE_STREAMS[video_id] = max(0, ACTIVE_STREAMS.get(video_id, 0) - 1)
+        current_listeners = ACTIVE_STREAMS[video_id]
+    with STREAM_IP_LOCK:
+        remaining = STREAM_IP_COUNTS.get(client_ip, 1) - 1
+        if remaining > 0:
+            STREAM_IP_COUNTS[client_ip] = remaining
+        else:
+            STREAM_IP_COUNTS.pop(client_ip, None)
+    print(f"[{sess['id']}] Listener OUT (Total: {current_listeners})", flush=True)
+    with SESSIONS_LOCK:
+        STREAM_SESSIONS.pop(session_key, None)
+    if sess['reaped']:
+        with LOG_LOCK:
+            REAPED_TOTAL += 1
+            REAPED_SESSIONS.append({
+                "id": sess['id'],
+                "video_id": video_id,
+                "codec": sess['codec'],
+                "bitrate": sess['bitrate'],
+                "client_ip": client_ip,
+                "reason": sess['reaped'],
+                "bytes_out": sess['bytes_out'],
+                "duration": int(time.monotonic() - sess['started']),
+                "time": datetime.now().strftime('%H:%M:%S')
+            })
+            ERROR_LOG.append(f"{datetime.now().strftime('%H:%M:%S')} - Reaped {video_id}: {sess['reaped']}")
+
 @app.route('/stream.mp3', methods=['GET', 'HEAD'])
+@app.route('/stream.aac', methods=['GET', 'HEAD'])
+@app.route('/stream.ogg', methods=['GET', 'HEAD'])
 def stream_audio():
+    codec = CODEC_BY_EXT[request.path.rsplit('.', 1)[1]]
+    mimetype = CODECS[codec]['mimetype']
     video_id = request.args.get('v')
     if not video_id:
         return "Missing video ID", 400
     if not valid_video_id(video_id):
         return "Invalid video ID", 400
+    bitrate = DEFAULT_BITRATE
+    if request.args.get('br'):
+        bitrate = parse_bitrate(request.args.get('br'))
+        if not bitrate:
+            return f"Unsupported bitrate; allowed: {', '.join(map(str, BITRATE_TIERS))}", 400
+    offset = None
+    if request.args.get('offset'):
+        if TIMESHIFT_MINUTES <= 0:
+            return "Timeshift is disabled", 400
+        try:
+            offset = float(request.args.get('offset'))
+        except ValueError:
+            return "Invalid offset", 400
+        if offset > 0 or offset != offset:
+            return "Offset must be zero or negative seconds", 400
+
+    # A draining worker leaves new listeners to its successor
+    if DRAIN_DEADLINE and request.method == 'GET':
+        return Response("Server restarting", 503, headers={'Retry-After': '2'})
 
     # Per-IP concurrency cap (HEAD probes are cheap and exempt)
     client_ip = request.remote_addr or 'unknown'
@@ -775,95 +3350,66 @@ def stream_audio():
 
     # Simple HEAD support
     if request.method == 'HEAD':
-        return Response(mimetype="audio/mpeg")
-    
-    youtube_url = build_youtube_url(video_id)
-    request_id = f"{video_id}_{int(time.time())}_{request.remote_addr[-4:]}"
+        return Response(mimetype=mimetype, headers={'icy-br': str(bitrate)})
+
+    request_id = f"{video_id}_{codec}_{bitrate}k_{int(time.time())}_{request.remote_addr[-4:]}"
     print(f"--- Stream Request Start: {request_id} ---", flush=True)
-    
+    # gunicorn and the werkzeug dev server both expose the raw client socket;
+    # the watchdog shuts it down to break a write blocked on a stalled client.
+    client_socket = request.environ.get('gunicorn.socket') or request.environ.get('werkzeug.socket')
+    # Direct socket writes are only safe where we know the server's framing rules:
+    # gunicorn chunks every HTTP/1.1 response that has no Content-Length.
+    relay_socket = request.environ.get('gunicorn.socket') if RELAY_DIRECT else None
+    relay_chunked = request.environ.get('SERVER_PROTOCOL', 'HTTP/1.0') != 'HTTP/1.0'
+
     def generate():
-        # Increment listener count
-        with STREAMS_LOCK:
-            ACTIVE_STREAMS[video_id] = ACTIVE_STREAMS.get(video_id, 0) + 1
-            current_listeners = ACTIVE_STREAMS[video_id]
-        with STREAM_IP_LOCK:
-            STREAM_IP_COUNTS[client_ip] = STREAM_IP_COUNTS.get(client_ip, 0) + 1
-        print(f"[{request_id}] Listener IN (Total: {current_listeners})", flush=True)
-            
-        ffmpeg_process = None 
+        sess = new_listener(
+            request_id, video_id, codec, bitrate, client_ip, client_socket, relay_chunked,
+            # A timeshift listener that stops reading is paused, not stalled — it
+            # can sit for as long as the buffer still holds its position.
+            max(LISTENER_STALL_TIMEOUT, TIMESHIFT_MINUTES * 60) if offset is not None else LISTENER_STALL_TIMEOUT
+        )
+        session_key = listener_in(sess)
+        encoder = None
+        reader = None
         try:
-            # 1. Get the direct audio URL from YouTube
-            print(f"[{request_id}] Fetching YouTube URL...", flush=True)
-            url_command = ['yt-dlp', '-g', '-f', 'ba/b', youtube_url]
-            url_proc = subprocess.run(url_command, capture_output=True, text=True)
-            
-            if url_proc.returncode != 0:
-                print(f"[{request_id}] yt-dlp error: {url_proc.stderr}", flush=True)
-                with LOG_LOCK:
-                    ERROR_LOG.append(f"{datetime.now().strftime('%H:%M:%S')} - yt-dlp Error: {video_id}")
-                return
-
-            direct_url = url_proc.stdout.strip()
-
-            # 2. Stream using FFmpeg
-            ffmpeg_command = [
-                'ffmpeg', '-i', direct_url, '-f', 'mp3', '-acodec', 'libmp3lame',
-                '-ab', '128k', '-flush_packets', '1', '-fflags', 'nobuffer',
-                '-loglevel', 'error', 'pipe:1'
-            ]
-            
-            ffmpeg_process = subprocess.Popen(
-                ffmpeg_command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=0
-            )
-            
-            while True:
-                chunk = ffmpeg_process.stdout.read(4096)
-                if not chunk:
-                    break
-                yield chunk
+            encoder, reader = subscribe_encoder(video_id, codec, bitrate, session_key, sess, timeshift=offset is not None)
+            if reader is None:
+                reader = TimeshiftReader(encoder, offset, sess)
+                print(f"[{request_id}] Timeshift from {reader.offset:.0f}s", flush=True)
+            sess['reader'] = reader
+            yield from relay_stream(reader, sess, relay_socket, relay_chunked)
+            if park_for_handoff(sess):
+                return  # The successor worker finishes the response
                 
         except GeneratorExit:
             print(f"[{request_id}] Browser disconnected.", flush=True)
+        except (BrokenPipeError, ConnectionResetError):
+            # Direct relay writes surface a client hang-up as a socket error
+            print(f"[{request_id}] Client disconnected.", flush=True)
         except Exception as e:
             print(f"[{request_id}] Error: {e}", flush=True)
-            with LOG_LOCK:
-                ERROR_LOG.append(f"{datetime.now().strftime('%H:%M:%S')} - Stream Error: {str(e)[:50]}")
+            if not sess['reaped']:
+                with LOG_LOCK:
+                    ERROR_LOG.append(f"{datetime.now().strftime('%H:%M:%S')} - Stream Error: {str(e)[:50]}")
         finally:
-            # Decrement listener count
-            with STREAMS_LOCK:
-                ACTIVE_STREAMS[video_id] = max(0, ACTIVE_STREAMS.get(video_id, 0) - 1)
-                current_listeners = ACTIVE_STREAMS[video_id]
-            with STREAM_IP_LOCK:
-                remaining = STREAM_IP_COUNTS.get(client_ip, 1) - 1
-                if remaining > 0:
-                    STREAM_IP_COUNTS[client_ip] = remaining
-                else:
-                    STREAM_IP_COUNTS.pop(client_ip, None)
-            print(f"[{request_id}] Listener OUT (Total: {current_listeners})", flush=True)
-            if ffmpeg_process: 
-                ffmpeg_process.terminate()
-                try:
-                    ffmpeg_process.wait(timeout=1)
-                except subprocess.TimeoutExpired:
-                    ffmpeg_process.kill()
-                    ffmpeg_process.wait() # Reap zombie process
-                except:
-                    ffmpeg_process.kill()
-                    ffmpeg_process.wait()
-                    
-                if ffmpeg_process.stdout:
-                    ffmpeg_process.stdout.close()
+            listener_out(session_key, sess)
+            if encoder:
+                unsubscribe_encoder(encoder, session_key)
+            if reader:
+                reader.close()
 
     return Response(
         generate(), 
-        mimetype="audio/mpeg",
+        mimetype=mimetype,
         headers={
             'Cache-Control': 'no-cache',
             'Accept-Ranges': 'none',
             'icy-name': station_name,
             'icy-description': 'Live2Audio YouTube Stream',
             'icy-url': build_youtube_url(video_id),
-            'icy-genre': 'YouTube Radio'
+            'icy-genre': 'YouTube Radio',
+            'icy-br': str(bitrate)
         }
     )
 
@@ -908,14 +3454,9 @@ def get_favicon_base():
 
 @app.route('/ping')
 def ping():
+    if DRAIN_DEADLINE:
+        return jsonify({'status': 'draining', 'message': 'restarting'}), 503
     return jsonify({'status': 'ok', 'message': 'pong'})
 
 if __name__ == '__main__':
-    # Pre-populate map when running locally
-    get_available_streams()
-    start_discovery_thread()
-    app.run(host='0.0.0.0', port=5001)
-else:
-    # Pre-populate map when running under Gunicorn
-    get_available_streams()
-    start_discovery_thread()
+    create_app().run(host='0.0.0.0', port=5001)
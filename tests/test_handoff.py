@@ -0,0 +1,93 @@
+"""The pieces a live handoff is built from: messages with descriptors across the
+handoff socket, readers that stop between reads and leave the rest to the
+successor, and processes watched without being their parent."""
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import stream_manager  # noqa: E402
+
+
+def receive_all(conn, replies):
+    """Receive messages until the sender closes, acking each with the next reply."""
+    received = []
+    while True:
+        msg, fds = stream_manager.recv_handoff(conn)
+        if msg is None:
+            return received
+        received.append((msg, fds))
+        conn.sendall(replies.pop(0))
+
+
+def test_messages_carry_descriptors():
+    ours, theirs = socket.socketpair()
+    r, w = os.pipe()
+    received = []
+    thread = threading.Thread(target=lambda: received.extend(receive_all(theirs, [b'+', b'-'])))
+    thread.start()
+    assert stream_manager.send_handoff(ours, {"type": "graph", "video_id": "x" * 11}, [r])
+    assert not stream_manager.send_handoff(ours, {"type": "settle", "video_id": "x" * 11})
+    ours.close()
+    thread.join()
+    theirs.close()
+    (first, fds), (second, no_fds) = received
+    assert first['type'] == 'graph' and second['type'] == 'settle' and no_fds == []
+    # The passed descriptor is the same pipe
+    os.write(w, b'pcm')
+    assert os.read(fds[0], 3) == b'pcm'
+    for fd in (r, w, fds[0]):
+        os.close(fd)
+
+
+def test_reader_stops_for_handoff_where_the_successor_resumes():
+    data = os.urandom(50000)
+    ring = stream_manager.new_ring(memoryview(bytearray(65536)), 65536, 16000)
+    enc = {"ring": ring, "ogg": None, "closing": False}
+    sess = {"handoff": None}
+    reader = stream_manager.RingReader(enc, ring, 0, sess)
+    stream_manager.ring_write(ring, data)
+    view = memoryview(bytearray(4096))
+    n = reader.readinto(view)
+    first = bytes(view[:n])
+
+    sess['handoff'] = {"parked": threading.Event(), "done": threading.Event(), "moved": False}
+    assert reader.readinto(view) == 0
+    successor = stream_manager.RingReader(enc, ring, reader.position)
+    enc['closing'] = True
+    rest = bytearray()
+    while True:
+        n = successor.readinto(view)
+        if not n:
+            break
+        rest += view[:n]
+    assert first + rest == data
+
+
+def test_log_reader_leaves_unread_lines_to_the_successor():
+    r, w = os.pipe()
+    graph = {"handoff": False}
+    lines = []
+    os.write(w, b'first\n')
+    thread = threading.Thread(target=lambda: lines.extend(stream_manager.pipe_lines(r, graph)))
+    thread.start()
+    time.sleep(0.1)
+    graph['handoff'] = True
+    thread.join()
+    os.write(w, b'second\n')
+    assert lines == ['first\n']
+    assert os.read(r, 100) == b'second\n'
+    os.close(r)
+    os.close(w)
+
+
+def test_adopted_process_sees_exit_without_waiting():
+    child = subprocess.Popen(['sleep', '0.3'])
+    proc = stream_manager.AdoptedProcess(child.pid)
+    assert proc.poll() is None
+    # Not reaped by us: it shows as a zombie until the parent waits
+    assert proc.wait(timeout=5) is not None
+    child.wait()
@@ -0,0 +1,164 @@
+"""relay_stream() must deliver exactly the bytes a plain read(4096) loop would,
+whichever path it takes: WSGI only, or WSGI for the first chunk and then
+sendall straight to the socket, with or without chunked framing. The same holds
+end to end for what listeners actually get: an output's pump writing its ring
+and a RingReader of that ring relayed to the socket."""
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import stream_manager  # noqa: E402
+
+PAYLOAD = random.Random(2024).randbytes(3 * 1024 * 1024 + 123)
+
+
+def pieces(data):
+    """`data` cut into uneven pieces, as ffmpeg's output arrives."""
+    rng = random.Random(7)
+    pos = 0
+    while pos < len(data):
+        step = rng.choice((1, 17, 4096, 5000, 70000))
+        yield data[pos:pos + step]
+        pos += step
+
+
+def feed(data):
+    """Return the read end of a pipe that `data` is written into in uneven pieces."""
+    r, w = os.pipe()
+
+    def write():
+        rng = random.Random(11)
+        with os.fdopen(w, 'wb', buffering=0) as out:
+            for piece in pieces(data):
+                out.write(piece)
+                if rng.random() < 0.01:
+                    time.sleep(0.001)  # Let the reader drain to a short read
+
+    threading.Thread(target=write, daemon=True).start()
+    return os.fdopen(r, 'rb', buffering=0)
+
+
+def plain_read(data):
+    """The reference: the old read(4096) loop."""
+    pipe = feed(data)
+    out = bytearray()
+    while True:
+        chunk = pipe.read(4096)
+        if not chunk:
+            return bytes(out)
+        out += chunk
+
+
+def new_session():
+    now = time.monotonic()
+    return {"bytes_in": 0, "bytes_out": 0, "last_write": now, "last_output": now}
+
+
+def new_output(capacity):
+    ring = stream_manager.new_ring(memoryview(bytearray(capacity)), capacity, 16000)
+    return {"ring": ring, "ogg": None, "closing": False}
+
+
+def pump(enc, reader, data):
+    """Write `data` into the output's ring as pump_output() does, but never lap
+    `reader`: the relay under test must see a listener that keeps up."""
+    ring = enc['ring']
+
+    def write():
+        for piece in pieces(data):
+            while ring['head'] + len(piece) - reader.position > ring['capacity']:
+                time.sleep(0.0005)
+            stream_manager.ring_write(ring, piece)
+        enc['closing'] = True
+        with ring['cond']:
+            ring['cond'].notify_all()
+
+    threading.Thread(target=write, daemon=True).start()
+
+
+def dechunk(raw):
+    out = bytearray()
+    pos = 0
+    while pos < len(raw):
+        end = raw.index(b'\r\n', pos)
+        size = int(raw[pos:end], 16)
+        start = end + 2
+        out += raw[start:start + size]
+        assert raw[start + size:start + size + 2] == b'\r\n'
+        pos = start + size + 2
+    return bytes(out)
+
+
+def relay_over_socket(source, chunked):
+    """Run relay_stream() with a socket: the first chunk comes back via WSGI (as
+    gunicorn would send it, framed when chunked) and the rest over the socket."""
+    ours, theirs = socket.socketpair()
+    received = bytearray()
+
+    def receive():
+        while True:
+            chunk = theirs.recv(65536)
+            if not chunk:
+                return
+            received.extend(chunk)
+
+    reader = threading.Thread(target=receive)
+    reader.start()
+    sess = new_session()
+    wsgi = bytearray()
+    for chunk in stream_manager.relay_stream(source, sess, ours, chunked):
+        wsgi += b'%X\r\n%s\r\n' % (len(chunk), chunk) if chunked else chunk
+    ours.shutdown(socket.SHUT_WR)
+    reader.join()
+    ours.close()
+    theirs.close()
+    body = bytes(wsgi + received)
+    return (dechunk(body) if chunked else body), sess
+
+
+def test_wsgi_path_matches_plain_read():
+    sess = new_session()
+    out = b''.join(stream_manager.relay_stream(feed(PAYLOAD), sess))
+    assert out == plain_read(PAYLOAD) == PAYLOAD
+    assert sess['bytes_in'] == sess['bytes_out'] == len(PAYLOAD)
+
+
+@pytest.mark.parametrize('chunked', [True, False])
+def test_sendall_path_matches_plain_read(chunked):
+    out, sess = relay_over_socket(feed(PAYLOAD), chunked)
+    assert out == plain_read(PAYLOAD)
+    assert sess['bytes_in'] == sess['bytes_out'] == len(PAYLOAD)
+
+
+@pytest.mark.parametrize('chunked', [True, False])
+def test_ring_reader_path_matches_plain_read(chunked):
+    # The smallest ring subscribe_encoder() builds, so writes wrap many times
+    enc = new_output(4 * stream_manager.RELAY_CHUNK_MAX)
+    reader = stream_manager.RingReader(enc, enc['ring'])
+    pump(enc, reader, PAYLOAD)
+    out, sess = relay_over_socket(reader, chunked)
+    assert out == plain_read(PAYLOAD)
+    assert sess['bytes_in'] == sess['bytes_out'] == len(PAYLOAD)
+
+
+def test_lapped_reader_resumes_at_live():
+    enc = new_output(65536)
+    reader = stream_manager.RingReader(enc, enc['ring'])
+    stream_manager.ring_write(enc['ring'], PAYLOAD[:200000])
+    # Live resumes with the next write
+    threading.Timer(0.1, stream_manager.ring_write, (enc['ring'], PAYLOAD[200000:201000])).start()
+    view = memoryview(bytearray(4096))
+    n = reader.readinto(view)
+    assert bytes(view[:n]) == PAYLOAD[200000:201000]
+
+
+def test_empty_source_sends_nothing():
+    out, sess = relay_over_socket(feed(b''), True)
+    assert out == b''
+    assert sess['bytes_out'] == 0